@@ -0,0 +1,16 @@
+import argparse
+
+from slac_pytorch.common.utils import parse_args
+from slac_pytorch.environments.remote import EnvServer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Host environment variants for remote SLAC trainers.")
+    parser.add_argument("--address", default="127.0.0.1:5555", help="host:port to listen on")
+    parser.add_argument("--config", default="./data/configs/default.json")
+    cli = parser.parse_args()
+
+    args = parse_args(args_file=cli.config)
+    with EnvServer(cli.address, args) as server:
+        print(f"Serving environments on {cli.address}.")
+        server.serve_forever()
@@ -0,0 +1,20 @@
+import argparse
+
+import torch
+
+from slac_pytorch.common.utils import parse_args
+from slac_pytorch.inference import PolicyServer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a trained SLAC policy with dynamic request batching.")
+    parser.add_argument("--address", default="127.0.0.1:5557", help="host:port to listen on")
+    parser.add_argument("--config", default="./data/configs/default.json")
+    parser.add_argument("--model-dir", required=True, help="directory written by SlacAlgorithm.save_model")
+    cli = parser.parse_args()
+
+    args = parse_args(args_file=cli.config)
+    device = torch.device("cuda" if args.cuda else "cpu")
+    with PolicyServer(cli.address, args, cli.model_dir, device) as server:
+        print(f"Serving policy from {cli.model_dir} on {cli.address}.")
+        server.serve_forever()
@@ -0,0 +1,16 @@
+import argparse
+
+from slac_pytorch.common.utils import parse_args
+from slac_pytorch.replay import ReplayServer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay service shared by SLAC collectors and learners.")
+    parser.add_argument("--address", default="127.0.0.1:5556", help="host:port to listen on")
+    parser.add_argument("--config", default="./data/configs/default.json")
+    cli = parser.parse_args()
+
+    args = parse_args(args_file=cli.config)
+    with ReplayServer(cli.address, args) as server:
+        print(f"Serving replay on {cli.address}.")
+        server.serve_forever()
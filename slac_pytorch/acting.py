@@ -0,0 +1,93 @@
+import copy
+from collections import deque
+from itertools import chain
+from time import perf_counter
+
+import numpy as np
+import torch
+
+
+class ActingEngine:
+    """
+    Computes single actions from a SlacObservation with the encoder and the actor. The observation is written
+    into preallocated (pinned, on CUDA) input buffers and the networks run under inference_mode, so that no
+    tensors but the outputs are allocated per step.
+
+    On the learner's device the engine shares the learner's networks. On another device (e.g. acting on the
+    CPU while learning on a GPU) it holds copies, which are refreshed by copying the weights in place once
+    they are marked stale. The latency of the last latency_window actions is recorded.
+    """
+
+    def __init__(self, encoder, actor, state_shape, action_shape, num_sequences, device, latency_window=10000):
+        self.device = torch.device(device)
+        self.source = (encoder, actor)
+        if next(actor.parameters()).device == self.device:
+            self.encoder, self.actor = encoder, actor
+        else:
+            self.encoder, self.actor = (copy.deepcopy(net).to(self.device) for net in self.source)
+        self.stale = False
+
+        pin = self.device.type == "cuda"
+        self._frames = torch.empty((num_sequences, *state_shape), dtype=torch.uint8, pin_memory=pin)
+        self._actions = torch.empty(((num_sequences - 1) * action_shape[0],), dtype=torch.float, pin_memory=pin)
+        self._frames_np = self._frames.numpy()
+        self._actions_np = self._actions.numpy()
+        if pin:
+            self._frames_dev = torch.empty_like(self._frames, device=self.device)
+            self._actions_dev = torch.empty_like(self._actions, device=self.device)
+        else:
+            self._frames_dev, self._actions_dev = self._frames, self._actions
+        self._state = torch.empty((num_sequences, *state_shape), dtype=torch.float, device=self.device)
+        self._latencies = deque(maxlen=latency_window)
+
+    def refresh(self):
+        """
+        Copy the learner's weights into the engine's networks, if it holds copies.
+        """
+        self.stale = False
+        if self.encoder is self.source[0]:
+            return
+        with torch.no_grad():
+            for net, source in zip((self.encoder, self.actor), self.source):
+                for x, y in chain(zip(net.parameters(), source.parameters()), zip(net.buffers(), source.buffers())):
+                    x.copy_(y, non_blocking=True)
+
+    def _write(self, ob):
+        # Fill the input buffers straight from the observation's frame and action histories.
+        if hasattr(ob, "write"):
+            ob.write(self._frames_np, self._actions_np)
+        else:
+            np.copyto(self._frames_np, ob.state[0])
+            np.copyto(self._actions_np, ob.action[0])
+        if self._frames_dev is not self._frames:
+            self._frames_dev.copy_(self._frames, non_blocking=True)
+            self._actions_dev.copy_(self._actions, non_blocking=True)
+
+    def act(self, ob, deterministic):
+        """
+        Action for the observation, the mean of the policy if deterministic or a sample otherwise.
+        """
+        start = perf_counter()
+        if self.stale:
+            self.refresh()
+        self._write(ob)
+        with torch.inference_mode():
+            state = self._state.copy_(self._frames_dev).div_(255.0)
+            feature = self.encoder(state[None]).view(1, -1)
+            feature_action = torch.cat([feature, self._actions_dev[None]], dim=1)
+            if deterministic:
+                action = self.actor(feature_action)
+            else:
+                action = self.actor.sample(feature_action)[0]
+            action = action[0].cpu().numpy()
+        self._latencies.append(perf_counter() - start)
+        return action
+
+    def latency_stats(self):
+        """
+        Median and 99th percentile of the recorded action latencies in milliseconds.
+        """
+        if not self._latencies:
+            return dict(p50=0.0, p99=0.0)
+        p50, p99 = np.percentile(np.array(self._latencies), [50, 99]) * 1000.0
+        return dict(p50=float(p50), p99=float(p99))
@@ -1,12 +1,32 @@
+import math
 import os
+from contextlib import nullcontext
+from itertools import chain
 
 import numpy as np
 import torch
 from torch.optim import Adam
 
-from slac_pytorch.buffer import ReplayBuffer
+from slac_pytorch.acting import ActingEngine
+from slac_pytorch.buffer import make_replay_buffer
+from slac_pytorch.export import export_policy
+from slac_pytorch.distributed import (
+    all_reduce_gradients,
+    all_reduce_value,
+    broadcast_parameters,
+    get_rank,
+    get_world_size,
+)
 from slac_pytorch.network import GaussianPolicy, LatentModel, ObsLatentModel, TwinnedQNetwork
-from slac_pytorch.utils import create_feature_actions, grad_false, soft_update
+from slac_pytorch.replay import ReplayClient
+from slac_pytorch.utils import (
+    ActivationMemoryMeter,
+    create_feature_actions,
+    grad_false,
+    soft_update,
+    time_limit_mask,
+    weighted_mean,
+)
 
 
 class SlacAlgorithm:
@@ -22,7 +42,8 @@ class SlacAlgorithm:
         action_shape,
         action_repeat,
         device,
-        args
+        args,
+        num_envs=1,
     ):
         assert args is not None, "No configuration settings"
         np.random.seed(args.seed)
@@ -30,7 +51,22 @@ class SlacAlgorithm:
         torch.cuda.manual_seed(args.seed)
 
         # Replay buffer.
-        self.buffer = ReplayBuffer(args.buffer_size, args.num_sequences, state_shape, action_shape, device)
+        self.prioritized = args.prioritized_replay
+        self.sharded = args.shard_replay
+        if args.replay_server:
+            # Trajectories are stored by a replay service shared with other collectors and learners.
+            assert not self.prioritized, "The replay service does not support prioritized replay."
+            self.buffer = ReplayClient(
+                args.replay_server,
+                args.num_sequences,
+                state_shape,
+                action_shape,
+                device,
+                num_shards=num_envs if self.sharded else 1,
+                flush_steps=args.replay_flush_steps,
+            )
+        else:
+            self.buffer = make_replay_buffer(args, state_shape, action_shape, device, num_envs)
 
         # Networks.
         self.actor = GaussianPolicy(action_shape, args.num_sequences, args.feature_dim, args.hidden_units).to(device)
@@ -48,7 +84,16 @@ class SlacAlgorithm:
         if len(args.critic_path) > 0:
             self.critic_target.load_state_dict(torch.load(args.critic_path))
             
-        self.latent = LatentModel(state_shape, action_shape, args.feature_dim, args.z1_dim, args.z2_dim, args.hidden_units).to(device)
+        self.latent = LatentModel(
+            state_shape,
+            action_shape,
+            args.feature_dim,
+            args.z1_dim,
+            args.z2_dim,
+            args.hidden_units,
+            decode_steps=args.decode_steps,
+            decode_mode=args.decode_mode,
+        ).to(device)
         
         if len(args.latent_path) > 0:
             self.latent.load_state_dict(torch.load(args.latent_path))
@@ -69,8 +114,15 @@ class SlacAlgorithm:
         self.optim_alpha = Adam([self.log_alpha], lr=args.lr_sac)
         self.optim_latent = Adam(self.latent.parameters(), lr=args.lr_latent)
 
+        # Data-parallel learners start from the weights of rank 0 and average their gradients.
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        self.sync_parameters()
+
         self.learning_steps_sac = 0
         self.learning_steps_latent = 0
+        # Bytes saved for the backward pass of the last measured latent and SAC updates.
+        self.saved_tensor_bytes = {}
         self.state_shape = state_shape
         self.action_shape = action_shape
         self.action_repeat = action_repeat
@@ -81,31 +133,67 @@ class SlacAlgorithm:
         self.num_sequences = args.num_sequences
         self.tau = args.tau
         self.beta = args.beta
+        self.lr_latent = args.lr_latent
+        # Large-batch latent model pretraining.
+        self.pretrain_batch_size_latent = int(args.pretrain_batch_size_latent)
+        self.pretrain_lr_scaling = args.pretrain_lr_scaling
+        self.pretrain_warmup_steps = int(args.pretrain_warmup_steps)
+        self.pretrain_max_epochs = int(args.pretrain_max_epochs)
+        self.pretrain_patience = int(args.pretrain_patience)
+        self.pretrain_min_delta = args.pretrain_min_delta
+        # Epochs over the replay buffer read blocks of stored trajectories, optionally prefetching batches.
+        self.latent_block_size = int(args.latent_block_size)
+        self.latent_shuffle_blocks = int(args.latent_shuffle_blocks)
+        self.latent_prefetch = int(args.latent_prefetch)
+        # Activation checkpointing and micro-batching of the latent model update.
+        self.checkpoint_latent = args.checkpoint_latent
+        self.latent_chunk_size = int(args.latent_chunk_size)
+        self.posterior_block_size = int(args.posterior_block_size)
 
         # JIT compile to speed up.
         fake_feature = torch.empty(1, args.num_sequences + 1, args.feature_dim, device=device)
         fake_action = torch.empty(1, args.num_sequences, action_shape[0], device=device)
         self.create_feature_actions = torch.jit.trace(create_feature_actions, (fake_feature, fake_action))
 
-    def preprocess(self, ob):
-        state = torch.tensor(ob.state, dtype=torch.uint8, device=self.device).float().div_(255.0)
+        # Single-step acting, optionally on another device than the learner.
+        self.acting_device = torch.device(args.acting_device) if args.acting_device else device
+        self.acting = self.make_acting_engine()
+
+    def make_acting_engine(self):
+        return ActingEngine(
+            self.latent.encoder, self.actor, self.state_shape, self.action_shape, self.num_sequences, self.acting_device
+        )
+
+    def sync_parameters(self):
+        """
+        Broadcast the weights of rank 0 to all data-parallel learners.
+        """
+        if self.world_size == 1:
+            return
+        broadcast_parameters(
+            chain(
+                self.latent.parameters(),
+                self.actor.parameters(),
+                self.critic.parameters(),
+                self.critic_target.parameters(),
+                [self.log_alpha],
+            )
+        )
         with torch.no_grad():
-            feature = self.latent.encoder(state).view(1, -1)
-        action = torch.tensor(ob.action, dtype=torch.float, device=self.device)
-        feature_action = torch.cat([feature, action], dim=1)
-        return feature_action
+            self.alpha = self.log_alpha.exp()
+
+    def reduce_gradients(self, params):
+        """
+        Average gradients over all data-parallel learners.
+        """
+        if self.world_size > 1:
+            all_reduce_gradients(params)
 
     def explore(self, ob):
-        feature_action = self.preprocess(ob)
-        with torch.no_grad():
-            action = self.actor.sample(feature_action)[0]
-        return action.cpu().numpy()[0]
+        return self.acting.act(ob, deterministic=False)
 
     def exploit(self, ob):
-        feature_action = self.preprocess(ob)
-        with torch.no_grad():
-            action = self.actor(feature_action)
-        return action.cpu().numpy()[0]
+        return self.acting.act(ob, deterministic=True)
 
     def step(self, env, ob, t, is_random):
         t += 1
@@ -118,8 +206,8 @@ class SlacAlgorithm:
         state, reward, terminated, truncated, infos = env.step(action)
         
         done = terminated or truncated
-        
-        mask = False if t == env.spec.max_episode_steps else done
+        # Time limits are not true terminal states.
+        mask = time_limit_mask(env, t, terminated, truncated)
         ob.append(state, action)
         self.buffer.append(action, reward, mask, state, done)
 
@@ -131,29 +219,153 @@ class SlacAlgorithm:
 
         return t
 
-    def update_latent(self, writer):
+    def update_latent(self, writer, num_updates=1):
+        """
+        Perform num_updates latent model updates on minibatches drawn with a single sample call.
+        """
+        batch = self.buffer.sample_latent(self.batch_size_latent * num_updates)
+        # Prioritized sampling also returns importance sampling weights and indices.
+        for minibatch in zip(*(x.split(self.batch_size_latent) for x in batch)):
+            self._update_latent(*minibatch, writer=writer)
+
+    def update_latent_offline(self, batches, writer):
+        """
+        Update the latent variable model on the given batches, e.g. streamed from an offline dataset. Returns
+        the number of updates.
+        """
+        num_updates = 0
+        for state_, action_, reward_, done_ in batches:
+            self._update_latent(state_, action_, reward_, done_, writer=writer)
+            num_updates += 1
+        return num_updates
+
+    def pretrain_latent(self, writer):
+        """
+        Pretrain the latent model with large batches in epochs over the collected data. The learning rate is
+        scaled with the batch size and warmed up linearly, and training stops once the reconstruction and KL
+        losses plateau. Returns the number of epochs run.
+        """
+        assert self.pretrain_lr_scaling in ("linear", "sqrt", "none"), f"Unknown lr scaling: {self.pretrain_lr_scaling}"
+        # Batches cannot be larger than the smallest buffer of the data-parallel learners.
+        num_stored = int(all_reduce_value(len(self.buffer), "min"))
+        assert num_stored > 0, "Need collected trajectories to pretrain the latent model."
+        batch_size = min(self.pretrain_batch_size_latent, num_stored)
+        ratio = batch_size / self.batch_size_latent
+        scale = {"linear": ratio, "sqrt": math.sqrt(ratio), "none": 1.0}[self.pretrain_lr_scaling]
+        peak_lr = self.lr_latent * scale
+        # Data-parallel learners must run the same number of updates.
+        num_batches = num_stored // batch_size
+
+        best_loss = math.inf
+        bad_epochs = 0
+        step = 0
+        for epoch in range(1, self.pretrain_max_epochs + 1):
+            epoch_loss = 0.0
+            batches = self.buffer.iterate_latent(
+                batch_size,
+                num_batches,
+                block_size=self.latent_block_size,
+                shuffle_blocks=self.latent_shuffle_blocks,
+                prefetch=self.latent_prefetch,
+            )
+            for state_, action_, reward_, done_ in batches:
+                step += 1
+                warmup = min(1.0, step / max(1, self.pretrain_warmup_steps))
+                for group in self.optim_latent.param_groups:
+                    group["lr"] = self.lr_latent + (peak_lr - self.lr_latent) * warmup
+                loss_kld, loss_image, _ = self._update_latent(state_, action_, reward_, done_, writer=writer)
+                epoch_loss += (loss_kld + loss_image).item()
+            epoch_loss = all_reduce_value(epoch_loss / num_batches)
+            writer.add_scalar("pretrain/loss", epoch_loss, epoch)
+            writer.add_scalar("pretrain/lr", self.optim_latent.param_groups[0]["lr"], epoch)
+
+            if epoch == 1 or epoch_loss < best_loss - self.pretrain_min_delta * abs(best_loss):
+                best_loss = epoch_loss
+                bad_epochs = 0
+            else:
+                bad_epochs += 1
+                if bad_epochs >= self.pretrain_patience:
+                    break
+
+        # Back to the learning rate of the small-batch updates.
+        for group in self.optim_latent.param_groups:
+            group["lr"] = self.lr_latent
+        return epoch
+
+    def _update_latent(self, state_, action_, reward_, done_, weights=None, idxes=None, writer=None):
         self.learning_steps_latent += 1
-        state_, action_, reward_, done_ = self.buffer.sample_latent(self.batch_size_latent)
-        loss_kld, loss_image, loss_reward = self.latent.calculate_loss(state_, action_, reward_, done_)
+        self.acting.stale = True
+        log = self.learning_steps_latent % 1000 == 0
+
+        # Measure the activation memory of the forward pass whenever we log.
+        with ActivationMemoryMeter(self.device) if log else nullcontext() as meter:
+            loss_kld_, loss_image_, loss_reward_ = self.calculate_latent_loss(state_, action_, reward_, done_)
+            loss_kld = weighted_mean(loss_kld_, weights)
+            loss_image = weighted_mean(loss_image_, weights)
+            loss_reward = weighted_mean(loss_reward_, weights)
+
+        if idxes is not None:
+            # Sequences which the model reconstructs poorly are replayed more often.
+            errors = self.latent.reconstruction_error(loss_image_.detach(), state_) + loss_kld_.detach()
+            self.buffer.update_latent_priorities(idxes.numpy(), errors.cpu().numpy())
 
         self.optim_latent.zero_grad()
         (self.beta * loss_kld + loss_image + loss_reward).backward()
+        self.reduce_gradients(self.latent.parameters())
         self.optim_latent.step()
 
-        if self.learning_steps_latent % 1000 == 0:
+        if log:
             writer.add_scalar("loss/kld", loss_kld.item(), self.learning_steps_latent)
             writer.add_scalar("loss/reward", loss_reward.item(), self.learning_steps_latent)
             writer.add_scalar("loss/image", loss_image.item(), self.learning_steps_latent)
-
-    def update_sac(self, writer):
+            self.saved_tensor_bytes["latent"] = meter.saved_bytes
+            writer.add_scalar("memory/latent_activations_mb", meter.saved_bytes / 2**20, self.learning_steps_latent)
+            if meter.peak_allocated_bytes > 0:
+                writer.add_scalar("memory/latent_peak_mb", meter.peak_allocated_bytes / 2**20, self.learning_steps_latent)
+
+        return loss_kld.detach(), loss_image.detach(), loss_reward.detach()
+
+    def calculate_latent_loss(self, state_, action_, reward_, done_):
+        if self.checkpoint_latent or self.latent_chunk_size > 0 or self.posterior_block_size > 0:
+            return self.latent.calculate_loss_checkpointed(
+                state_,
+                action_,
+                reward_,
+                done_,
+                chunk_size=self.latent_chunk_size,
+                block_size=self.posterior_block_size,
+                checkpoint=self.checkpoint_latent,
+            )
+        return self.latent.calculate_loss(state_, action_, reward_, done_)
+
+    def update_sac(self, writer, num_updates=1):
+        """
+        Perform num_updates SAC updates on minibatches drawn with a single sample call.
+        """
+        batch = self.buffer.sample_sac(self.batch_size_sac * num_updates)
+        # Prioritized sampling also returns importance sampling weights and indices.
+        for minibatch in zip(*(x.split(self.batch_size_sac) for x in batch)):
+            self._update_sac(*minibatch, writer=writer)
+
+    def _update_sac(self, state_, action_, reward, done, weights=None, idxes=None, writer=None):
         self.learning_steps_sac += 1
-        state_, action_, reward, done = self.buffer.sample_sac(self.batch_size_sac)
-        z, next_z, action, feature_action, next_feature_action = self.prepare_batch(state_, action_)
+        self.acting.stale = True
+        log = self.learning_steps_sac % 1000 == 0
 
-        self.update_critic(z, next_z, action, next_feature_action, reward, done, writer)
-        self.update_actor(z, feature_action, writer)
+        # Measure the activation memory of the critic and actor updates whenever we log.
+        with ActivationMemoryMeter(self.device) if log else nullcontext() as meter:
+            z, next_z, action, feature_action, next_feature_action = self.prepare_batch(state_, action_)
+
+            td_error = self.update_critic(z, next_z, action, next_feature_action, reward, done, writer, weights)
+            if idxes is not None:
+                self.buffer.update_sac_priorities(idxes.numpy(), td_error.cpu().numpy())
+            self.update_actor(z, feature_action, writer)
         soft_update(self.critic_target, self.critic, self.tau)
 
+        if log:
+            self.saved_tensor_bytes["sac"] = meter.saved_bytes
+            writer.add_scalar("memory/sac_activations_mb", meter.saved_bytes / 2**20, self.learning_steps_sac)
+
     def prepare_batch(self, state_, action_):
         with torch.no_grad():
             # f(1:t+1)
@@ -170,22 +382,29 @@ class SlacAlgorithm:
 
         return z, next_z, action, feature_action, next_feature_action
 
-    def update_critic(self, z, next_z, action, next_feature_action, reward, done, writer):
+    def update_critic(self, z, next_z, action, next_feature_action, reward, done, writer, weights=None):
         curr_q1, curr_q2 = self.critic(z, action)
         with torch.no_grad():
             next_action, log_pi = self.actor.sample(next_feature_action)
             next_q1, next_q2 = self.critic_target(next_z, next_action)
             next_q = torch.min(next_q1, next_q2) - self.alpha * log_pi
         target_q = reward + (1.0 - done) * self.gamma * next_q
-        loss_critic = (curr_q1 - target_q).pow_(2).mean() + (curr_q2 - target_q).pow_(2).mean()
+        loss_critic = weighted_mean((curr_q1 - target_q).pow(2).squeeze(1), weights) + weighted_mean(
+            (curr_q2 - target_q).pow(2).squeeze(1), weights
+        )
 
         self.optim_critic.zero_grad()
         loss_critic.backward(retain_graph=False)
+        self.reduce_gradients(self.critic.parameters())
         self.optim_critic.step()
 
         if self.learning_steps_sac % 1000 == 0:
             writer.add_scalar("loss/critic", loss_critic.item(), self.learning_steps_sac)
 
+        # Mean absolute TD error of the twinned Q functions.
+        with torch.no_grad():
+            return 0.5 * ((curr_q1 - target_q).abs() + (curr_q2 - target_q).abs()).squeeze(1)
+
     def update_actor(self, z, feature_action, writer):
         action, log_pi = self.actor.sample(feature_action)
         q1, q2 = self.critic(z, action)
@@ -193,6 +412,7 @@ class SlacAlgorithm:
 
         self.optim_actor.zero_grad()
         loss_actor.backward(retain_graph=False)
+        self.reduce_gradients(self.actor.parameters())
         self.optim_actor.step()
 
         with torch.no_grad():
@@ -201,6 +421,7 @@ class SlacAlgorithm:
 
         self.optim_alpha.zero_grad()
         loss_alpha.backward(retain_graph=False)
+        self.reduce_gradients([self.log_alpha])
         self.optim_alpha.step()
         with torch.no_grad():
             self.alpha = self.log_alpha.exp()
@@ -211,6 +432,15 @@ class SlacAlgorithm:
             writer.add_scalar("stats/alpha", self.alpha.item(), self.learning_steps_sac)
             writer.add_scalar("stats/entropy", entropy.item(), self.learning_steps_sac)
 
+    def export_policy(self, path, quantization_mode="dynamic", num_batches=8):
+        """
+        Export the encoder and actor as a frozen TorchScript policy, calibrated and checked on num_batches
+        batches sampled from the replay buffer. Returns the export report.
+        """
+        # Prioritized sampling also returns importance sampling weights and indices.
+        batches = [self.buffer.sample_latent(self.batch_size_latent)[:2] for _ in range(num_batches)]
+        return export_policy(self.latent.encoder, self.actor, path, self.num_sequences, batches, quantization_mode)
+
     def save_model(self, save_dir):
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
@@ -229,10 +459,25 @@ class ObsSlacAlgorithm(SlacAlgorithm):
                  action_shape,
                  action_repeat,
                  device,
-                 args):
+                 args,
+                 num_envs=1):
         super().__init__(state_shape,
                          action_shape,
                          action_repeat,
                          device,
-                         args)
-        self.latent = ObsLatentModel(state_shape, action_shape, args.feature_dim, args.z1_dim, args.z2_dim, args.hidden_units).to(device)
\ No newline at end of file
+                         args,
+                         num_envs)
+        self.latent = ObsLatentModel(
+            state_shape,
+            action_shape,
+            args.feature_dim,
+            args.z1_dim,
+            args.z2_dim,
+            args.hidden_units,
+            decode_steps=args.decode_steps,
+            decode_mode=args.decode_mode,
+        ).to(device)
+        # The optimizer and the acting engine have to track the parameters of the replaced latent model.
+        self.optim_latent = Adam(self.latent.parameters(), lr=args.lr_latent)
+        self.acting = self.make_acting_engine()
+        self.sync_parameters()
@@ -3,18 +3,26 @@ from collections import deque
 import numpy as np
 import torch
 
+from slac_pytorch.utils import prefetch_iterator
+
 
 class LazyFrames:
     """
     Stacked frames which never allocate memory to the same frame.
     """
 
+    # There is one instance per stored sequence, so skip the instance dict.
+    __slots__ = ("_frames",)
+
     def __init__(self, frames):
         self._frames = list(frames)
 
     def __array__(self, dtype):
         return np.array(self._frames, dtype=dtype)
 
+    def __getitem__(self, i):
+        return self._frames[i]
+
     def __len__(self):
         return len(self._frames)
 
@@ -112,6 +120,12 @@ class ReplayBuffer:
         if episode_done:
             self.buff.reset()
 
+    def add_sequence(self, state_, action_, reward_, done_):
+        """
+        Store one complete sequence of trajectories, e.g. one assembled by another process.
+        """
+        self._append(state_, action_, reward_, done_)
+
     def _append(self, state_, action_, reward_, done_):
         self.state_[self._p] = state_
         self.action_[self._p].copy_(torch.as_tensor(action_, dtype=torch.float32))
@@ -121,33 +135,283 @@ class ReplayBuffer:
         self._n = min(self._n + 1, self.buffer_size)
         self._p = (self._p + 1) % self.buffer_size
 
+    def _sample_idxes(self, batch_size, weights=None):
+        return np.random.randint(low=0, high=self._n, size=batch_size)
+
     def sample_latent(self, batch_size):
         """
         Sample trajectories for updating latent variable model.
         """
-        idxes = np.random.randint(low=0, high=self._n, size=batch_size)
-        state_ = np.empty((batch_size, self.num_sequences + 1, *self.state_shape), dtype=np.uint8)
-        
-        # print(state_.shape)
-        # print(state_[0, ...].shape)
-
-        for i, idx in enumerate(idxes):
-            state_[i, ...] = self.state_[idx]
-            
-            
-        state_ = torch.tensor(state_, dtype=torch.uint8, device=self.device).float().div_(255.0)
-        return state_, self.action_[idxes], self.reward_[idxes], self.done_[idxes]
+        return self.get_latent(self._sample_idxes(batch_size))
 
     def sample_sac(self, batch_size):
         """
         Sample trajectories for updating SAC.
         """
-        idxes = np.random.randint(low=0, high=self._n, size=batch_size)
-        state_ = np.empty((batch_size, self.num_sequences + 1, *self.state_shape), dtype=np.uint8)
+        return self.get_sac(self._sample_idxes(batch_size))
+
+    def iterate_latent(self, batch_size, num_batches=None, block_size=0, shuffle_blocks=8, prefetch=0):
+        """
+        Iterate over the stored trajectories once in random order, yielding batches like sample_latent.
+        By default every full batch of the epoch is yielded.
+
+        With block_size > 0, the trajectories are read in windows of shuffle_blocks randomly chosen blocks of
+        block_size contiguously stored trajectories, each window in one pass in storage order, and shuffled
+        within the window. With prefetch > 0, up to that many batches are assembled ahead in a background thread.
+        """
+        idxes = self._stored_idxes()
+        if num_batches is None:
+            num_batches = len(idxes) // batch_size
+        if block_size > 0:
+            batches = self._iterate_blocks(idxes, batch_size, num_batches, block_size, shuffle_blocks)
+        else:
+            idxes = np.random.permutation(idxes)
+            batches = (self.get_latent(idxes[i * batch_size : (i + 1) * batch_size]) for i in range(num_batches))
+        return prefetch_iterator(batches, prefetch) if prefetch > 0 else batches
+
+    def _stored_idxes(self):
+        return np.arange(self._n)
+
+    def _iterate_blocks(self, idxes, batch_size, num_batches, block_size, shuffle_blocks):
+        starts = np.random.permutation(np.arange(0, len(idxes), block_size))
+        window_size = max(1, shuffle_blocks)
+        carry = None
+        for w in range(0, len(starts), window_size):
+            window = np.sort(np.concatenate([idxes[s : s + block_size] for s in starts[w : w + window_size]]))
+            frames = self.get_frames(window)
+            action_, reward_, done_ = self.action_[window], self.reward_[window], self.done_[window]
+            if carry is not None:
+                # Trajectories left over from the previous window.
+                frames = np.concatenate([carry[0], frames])
+                action_, reward_, done_ = (torch.cat([c, x]) for c, x in zip(carry[1:], (action_, reward_, done_)))
+            order = np.random.permutation(len(frames))
+            num_full = len(order) // batch_size
+            for i in range(num_full):
+                if num_batches == 0:
+                    return
+                batch = order[i * batch_size : (i + 1) * batch_size]
+                state_ = torch.tensor(frames[batch], dtype=torch.uint8, device=self.device).float().div_(255.0)
+                yield state_, action_[batch], reward_[batch], done_[batch]
+                num_batches -= 1
+            rest = order[num_full * batch_size :]
+            carry = (frames[rest], action_[rest], reward_[rest], done_[rest])
+
+    def get_latent(self, idxes):
+        state_ = self._get_states(idxes)
+        return state_, self.action_[idxes], self.reward_[idxes], self.done_[idxes]
+
+    def get_sac(self, idxes):
+        state_ = self._get_states(idxes)
+        return state_, self.action_[idxes], self.reward_[idxes, -1], self.done_[idxes, -1]
+
+    def get_frames(self, idxes):
+        """
+        Raw uint8 image sequences of the given trajectories.
+        """
+        state_ = np.empty((len(idxes), self.num_sequences + 1, *self.state_shape), dtype=np.uint8)
         for i, idx in enumerate(idxes):
             state_[i, ...] = self.state_[idx]
-        state_ = torch.tensor(state_, dtype=torch.uint8, device=self.device).float().div_(255.0)
-        return state_, self.action_[idxes], self.reward_[idxes, -1], self.done_[idxes, -1]
+        return state_
+
+    def _get_states(self, idxes):
+        state_ = self.get_frames(idxes)
+        return torch.tensor(state_, dtype=torch.uint8, device=self.device).float().div_(255.0)
 
     def __len__(self):
         return self._n
+
+
+class ShardedReplayBuffer(ReplayBuffer):
+    """
+    Replay Buffer with one shard per environment variant. Each shard has its own capacity and write index,
+    while all shards share contiguous storage so that a batch mixing several shards is a single gather.
+    """
+
+    def __init__(self, shard_sizes, num_sequences, state_shape, action_shape, device, mixing_weights=None):
+        self.shard_sizes = np.array([int(size) for size in shard_sizes], dtype=np.int64)
+        super().__init__(self.shard_sizes.sum(), num_sequences, state_shape, action_shape, device)
+        self.num_shards = len(self.shard_sizes)
+        self.offsets = np.concatenate(([0], np.cumsum(self.shard_sizes)[:-1]))
+        self.shard_n = np.zeros(self.num_shards, dtype=np.int64)
+        self.shard_p = np.zeros(self.num_shards, dtype=np.int64)
+        self.mixing_weights = mixing_weights
+        self.shard = 0
+
+    def set_shard(self, shard):
+        """
+        Route the trajectories of the following episodes to the given shard.
+        """
+        assert 0 <= shard < self.num_shards, f"Unknown shard: {shard}"
+        self.shard = shard
+
+    def _append(self, state_, action_, reward_, done_):
+        s = self.shard
+        self._p = self.offsets[s] + self.shard_p[s]
+        super()._append(state_, action_, reward_, done_)
+        self.shard_n[s] = min(self.shard_n[s] + 1, self.shard_sizes[s])
+        self.shard_p[s] = (self.shard_p[s] + 1) % self.shard_sizes[s]
+        self._n = int(self.shard_n.sum())
+
+    def _shard_probs(self, weights):
+        if weights is None:
+            weights = self.mixing_weights
+        # Balanced over the shards by default, and shards without data are never sampled.
+        probs = np.ones(self.num_shards) if weights is None else np.asarray(weights, dtype=np.float64)
+        probs = probs * (self.shard_n > 0)
+        assert probs.sum() > 0, "No data in the shards with positive mixing weight."
+        return probs / probs.sum()
+
+    def _sample_idxes(self, batch_size, weights=None):
+        shards = np.random.choice(self.num_shards, size=batch_size, p=self._shard_probs(weights))
+        local = (np.random.random_sample(batch_size) * self.shard_n[shards]).astype(np.int64)
+        return self.offsets[shards] + local
+
+    def sample_latent(self, batch_size, weights=None):
+        """
+        Sample trajectories for updating latent variable model, mixing the shards with the given weights
+        (defaults to mixing_weights, or uniform over shards).
+        """
+        return self.get_latent(self._sample_idxes(batch_size, weights))
+
+    def sample_sac(self, batch_size, weights=None):
+        """
+        Sample trajectories for updating SAC, mixing the shards with the given weights (defaults to
+        mixing_weights, or uniform over shards).
+        """
+        return self.get_sac(self._sample_idxes(batch_size, weights))
+
+    def _stored_idxes(self):
+        return np.concatenate([offset + np.arange(n) for offset, n in zip(self.offsets, self.shard_n)])
+
+
+class SumTree:
+    """
+    Array-based sum-tree over a fixed number of leaves. Sampling and priority updates are vectorized over
+    the whole batch and walk the tree level by level.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self._depth = max(1, (self.capacity - 1).bit_length())
+        self._size = 1 << self._depth
+        # Node i has children 2i and 2i+1, the leaves are stored at [size, 2 * size).
+        self._tree = np.zeros(2 * self._size, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self._tree[1]
+
+    def get(self, idxes):
+        return self._tree[np.asarray(idxes) + self._size]
+
+    def update(self, idxes, priorities):
+        nodes = np.asarray(idxes, dtype=np.int64) + self._size
+        self._tree[nodes] = priorities
+        for _ in range(self._depth):
+            nodes >>= 1
+            # Duplicate nodes are harmless since all their children are already up to date.
+            self._tree[nodes] = self._tree[2 * nodes] + self._tree[2 * nodes + 1]
+
+    def sample(self, batch_size):
+        """
+        Stratified sampling of leaves proportionally to their priorities.
+        """
+        u = (np.arange(batch_size) + np.random.random_sample(batch_size)) * (self.total / batch_size)
+        nodes = np.ones(batch_size, dtype=np.int64)
+        for _ in range(self._depth):
+            nodes <<= 1
+            left = self._tree[nodes]
+            right = u >= left
+            u -= left * right
+            nodes += right
+        return nodes - self._size
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    Replay Buffer which samples trajectories proportionally to their priorities. The latent model and SAC
+    keep separate priorities, and new trajectories get the highest priority seen so far.
+
+    Paper: https://arxiv.org/abs/1511.05952
+    """
+
+    def __init__(self, buffer_size, num_sequences, state_shape, action_shape, device, alpha=0.6, beta=0.4, eps=1e-6):
+        super().__init__(buffer_size, num_sequences, state_shape, action_shape, device)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.tree_latent = SumTree(self.buffer_size)
+        self.tree_sac = SumTree(self.buffer_size)
+        self._max_priority_latent = 1.0
+        self._max_priority_sac = 1.0
+
+    def _append(self, state_, action_, reward_, done_):
+        p = self._p
+        super()._append(state_, action_, reward_, done_)
+        self.tree_latent.update([p], [self._max_priority_latent])
+        self.tree_sac.update([p], [self._max_priority_sac])
+
+    def _sample(self, tree, batch_size):
+        # Guard against rounding errors reaching the empty leaves.
+        idxes = np.minimum(tree.sample(batch_size), self._n - 1)
+        probs = np.maximum(tree.get(idxes) / tree.total, 1e-12)
+        # Importance sampling weights, normalized by the largest weight in the batch.
+        weights = (self._n * probs) ** -self.beta
+        weights = torch.as_tensor(weights / weights.max(), dtype=torch.float32, device=self.device)
+        return idxes, weights
+
+    def sample_latent(self, batch_size):
+        """
+        Sample trajectories for updating latent variable model, together with their importance sampling
+        weights and indices.
+        """
+        idxes, weights = self._sample(self.tree_latent, batch_size)
+        return (*self.get_latent(idxes), weights, torch.as_tensor(idxes))
+
+    def sample_sac(self, batch_size):
+        """
+        Sample trajectories for updating SAC, together with their importance sampling weights and indices.
+        """
+        idxes, weights = self._sample(self.tree_sac, batch_size)
+        return (*self.get_sac(idxes), weights, torch.as_tensor(idxes))
+
+    def update_latent_priorities(self, idxes, errors):
+        priorities = (np.abs(np.asarray(errors, dtype=np.float64)) + self.eps) ** self.alpha
+        self.tree_latent.update(idxes, priorities)
+        self._max_priority_latent = max(self._max_priority_latent, priorities.max())
+
+    def update_sac_priorities(self, idxes, errors):
+        priorities = (np.abs(np.asarray(errors, dtype=np.float64)) + self.eps) ** self.alpha
+        self.tree_sac.update(idxes, priorities)
+        self._max_priority_sac = max(self._max_priority_sac, priorities.max())
+
+
+def make_replay_buffer(args, state_shape, action_shape, device, num_envs=1):
+    """
+    Build the replay buffer selected by the configuration.
+    """
+    assert not (args.prioritized_replay and args.shard_replay), "Prioritized replay does not support sharding."
+    if args.shard_replay:
+        # One shard per environment variant, splitting buffer_size evenly unless sized explicitly.
+        shard_sizes = args.shard_buffer_sizes or [int(args.buffer_size) // num_envs] * num_envs
+        assert len(shard_sizes) == num_envs, "Need one shard size per environment."
+        return ShardedReplayBuffer(
+            shard_sizes,
+            args.num_sequences,
+            state_shape,
+            action_shape,
+            device,
+            mixing_weights=args.shard_mixing_weights,
+        )
+    if args.prioritized_replay:
+        return PrioritizedReplayBuffer(
+            args.buffer_size,
+            args.num_sequences,
+            state_shape,
+            action_shape,
+            device,
+            alpha=args.priority_alpha,
+            beta=args.priority_beta,
+            eps=args.priority_eps,
+        )
+    return ReplayBuffer(args.buffer_size, args.num_sequences, state_shape, action_shape, device)
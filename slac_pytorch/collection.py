@@ -0,0 +1,157 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from slac_pytorch.replay import RESET_EPISODE, STEP
+from slac_pytorch.utils import time_limit_mask
+
+RECORD_FIELDS = ("kinds", "states", "actions", "rewards", "dones", "episode_dones")
+
+
+def collect_random(env, num_steps, seed):
+    """
+    Step the environment with uniformly random actions for num_steps steps, recording the episodes as a stream
+    of reset and step records in which every frame is stored once.
+    """
+    env.action_space.seed(seed)
+    records = {field: [] for field in RECORD_FIELDS}
+    zero_action = np.zeros(env.action_space.shape, dtype=np.float32)
+
+    def record(kind, state, action, reward, done, episode_done):
+        for field, value in zip(RECORD_FIELDS, (kind, state, action, reward, done, episode_done)):
+            records[field].append(value)
+
+    t = 0
+    state, _ = env.reset(seed=seed)
+    record(RESET_EPISODE, state, zero_action, 0.0, False, False)
+    for step in range(1, num_steps + 1):
+        t += 1
+        action = env.action_space.sample()
+        state, reward, terminated, truncated, _ = env.step(action)
+        done = terminated or truncated
+        record(STEP, state, action, reward, time_limit_mask(env, t, terminated, truncated), done)
+        # Records end with a step, so a new episode only starts when more steps follow.
+        if done and step < num_steps:
+            t = 0
+            state, _ = env.reset()
+            record(RESET_EPISODE, state, zero_action, 0.0, False, False)
+
+    return dict(
+        kinds=np.array(records["kinds"], dtype=np.uint8),
+        states=np.stack(records["states"]),
+        actions=np.stack(records["actions"]).astype(np.float32),
+        rewards=np.array(records["rewards"], dtype=np.float32),
+        dones=np.array(records["dones"], dtype=bool),
+        episode_dones=np.array(records["episode_dones"], dtype=bool),
+    )
+
+
+def add_episodes(buffer, kinds, states, actions, rewards, dones, episode_dones):
+    """
+    Store recorded episodes in a replay buffer exactly as if they were collected live. The last episode is
+    closed after its final record.
+    """
+    for i, kind in enumerate(kinds):
+        if kind == RESET_EPISODE:
+            buffer.reset_episode(states[i])
+        else:
+            episode_done = bool(episode_dones[i]) or i == len(kinds) - 1
+            buffer.append(actions[i], rewards[i].item(), bool(dones[i]), states[i], episode_done)
+
+
+def _collect_chunk(args, variant, from_pixels, universe, num_steps, seed):
+    # Imported here so that only the worker processes build environments.
+    from slac_pytorch.environments.factory import EnvVariantFactory
+
+    factory = EnvVariantFactory(args, cache_dir=args.env_cache_dir, universe=universe)
+    env = factory.make(variant, from_pixels)
+    try:
+        return collect_random(env, num_steps, seed)
+    finally:
+        env.close()
+
+
+class RandomCollectionCache:
+    """
+    Cache of the transitions of the initial random-policy phase, which do not depend on the model. Datasets
+    are keyed by environment, variant, action repeat, seed, observation shape and number of steps, and a
+    missing one is generated in num_workers independently seeded chunks on a process pool.
+    """
+
+    def __init__(self, args, variant, from_pixels=True, universe=None):
+        self.args = args
+        self.variant = dict(variant)
+        self.from_pixels = from_pixels
+        self.universe = universe or args.universe
+        self.cache_dir = args.random_cache_dir
+        self.num_steps = int(args.initial_collection_steps)
+        self.num_chunks = max(1, int(args.random_collection_workers))
+
+    def key(self, state_shape):
+        from slac_pytorch.environments.factory import EnvVariantFactory
+
+        # The variant's MJCF file is named after the hash of its content.
+        agent_file = EnvVariantFactory(self.args, cache_dir=self.args.env_cache_dir).agent_file(self.variant)
+        return dict(
+            universe=self.universe,
+            domain_name=self.args.domain_name,
+            task_name=self.args.task_name,
+            agent=os.path.basename(agent_file),
+            from_pixels=self.from_pixels,
+            action_repeat=self.args.action_repeat,
+            seed=self.args.seed,
+            state_shape=list(state_shape),
+            num_steps=self.num_steps,
+            num_chunks=self.num_chunks,
+        )
+
+    def path(self, state_shape):
+        digest = hashlib.sha256(json.dumps(self.key(state_shape), sort_keys=True).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"random-{digest}.npz")
+
+    def generate(self):
+        """
+        Collect the dataset, splitting the steps into chunks with their own environment instances and seeds.
+        """
+        sizes = [len(chunk) for chunk in np.array_split(np.arange(self.num_steps), self.num_chunks) if len(chunk)]
+        seeds = [int(s) for s in np.random.SeedSequence(self.args.seed).generate_state(len(sizes))]
+        jobs = [(self.args, self.variant, self.from_pixels, self.universe, n, s) for n, s in zip(sizes, seeds)]
+        if len(jobs) == 1:
+            chunks = [_collect_chunk(*jobs[0])]
+        else:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count()), mp_context=context) as executor:
+                chunks = list(executor.map(_collect_chunk, *zip(*jobs)))
+        data = {field: np.concatenate([chunk[field] for chunk in chunks]) for field in RECORD_FIELDS}
+        # Every chunk closes its last episode.
+        ends = np.cumsum([len(chunk["kinds"]) for chunk in chunks]) - 1
+        data["episode_dones"][ends] = True
+        return data
+
+    def load(self, state_shape):
+        """
+        The cached dataset for the given observation shape, generated and stored on a miss.
+        """
+        path = self.path(state_shape)
+        if os.path.exists(path):
+            with np.load(path) as f:
+                return {field: f[field] for field in RECORD_FIELDS}
+
+        data = self.generate()
+        assert data["states"].shape[1:] == tuple(state_shape), "Observation shape does not match the cache key."
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write atomically, so that concurrent runs never read a partial file.
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp.npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **data)
+        os.replace(tmp_path, path)
+        return data
+
+    def load_into(self, buffer):
+        data = self.load(buffer.state_shape)
+        add_episodes(buffer, *(data[field] for field in RECORD_FIELDS))
@@ -0,0 +1,87 @@
+import json
+import socket
+import struct
+
+import numpy as np
+
+# Message header: opcode and number of arrays.
+_HEADER = struct.Struct("<BH")
+# Array header: dtype code length and number of dimensions, followed by the dtype code and the shape.
+_ARRAY = struct.Struct("<BB")
+
+
+def connect(address):
+    """
+    Open a low-latency TCP connection to "host:port".
+    """
+    host, port = address.rsplit(":", 1)
+    sock = socket.create_connection((host, int(port)))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def encode_json(obj):
+    return np.frombuffer(json.dumps(obj).encode(), dtype=np.uint8)
+
+
+def decode_json(array):
+    return json.loads(array.tobytes().decode())
+
+
+def send_message(sock, op, arrays=()):
+    """
+    Send an opcode with a list of numpy arrays. The array data is handed to the socket without being copied
+    into an intermediate buffer.
+    """
+    arrays = [np.asarray(a) for a in arrays]
+    arrays = [a if a.flags.c_contiguous else a.copy() for a in arrays]
+    header = [_HEADER.pack(op, len(arrays))]
+    for a in arrays:
+        code = a.dtype.str.encode()
+        header.append(_ARRAY.pack(len(code), a.ndim) + code + struct.pack(f"<{a.ndim}Q", *a.shape))
+    _send_all(sock, [b"".join(header)] + [_bytes_view(a) for a in arrays])
+
+
+def recv_message(sock):
+    """
+    Receive an opcode and its arrays, which are read straight into freshly allocated numpy arrays.
+    """
+    op, count = _HEADER.unpack(_recv_bytes(sock, _HEADER.size))
+    arrays = []
+    for _ in range(count):
+        code_len, ndim = _ARRAY.unpack(_recv_bytes(sock, _ARRAY.size))
+        dtype = np.dtype(_recv_bytes(sock, code_len).decode())
+        shape = struct.unpack(f"<{ndim}Q", _recv_bytes(sock, 8 * ndim))
+        arrays.append(np.empty(shape, dtype=dtype))
+    for a in arrays:
+        _recv_into(sock, _bytes_view(a))
+    return op, arrays
+
+
+def _bytes_view(array):
+    return memoryview(array.reshape(-1).view(np.uint8))
+
+
+def _send_all(sock, buffers):
+    buffers = [b for b in buffers if len(b) > 0]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if sent > 0:
+            buffers[0] = buffers[0][sent:]
+
+
+def _recv_into(sock, view):
+    while len(view) > 0:
+        n = sock.recv_into(view)
+        if n == 0:
+            raise ConnectionError("Connection closed by peer.")
+        view = view[n:]
+
+
+def _recv_bytes(sock, size):
+    data = bytearray(size)
+    _recv_into(sock, memoryview(data))
+    return bytes(data)
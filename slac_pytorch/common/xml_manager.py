@@ -26,11 +26,17 @@ class XML:
         
         
         tree = ET.parse(input_file)
-        self.modify_mass(tree, values['mass'])
-        self.modify_friction(tree, values['friction'])
+        self.modify_tree(tree, values)
         
         tree.write(output_file)
 
+    def modify_tree(self, tree, values):
+        """
+        Apply the values to an already parsed tree in place.
+        """
+        self.modify_mass(tree, values['mass'])
+        self.modify_friction(tree, values['friction'])
+
     def modify_mass(self, tree, value):
         for elem in tree.iterfind('worldbody/body/geom'):
             elem.set('density', str(value))
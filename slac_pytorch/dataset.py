@@ -0,0 +1,271 @@
+import json
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from slac_pytorch.collection import RECORD_FIELDS, add_episodes
+from slac_pytorch.replay import RESET_EPISODE, STEP
+from slac_pytorch.utils import prefetch_iterator
+
+MANIFEST_FILE = "manifest.json"
+FORMAT_VERSION = 1
+
+
+class DatasetWriter:
+    """
+    Writes trajectories to a directory of .npz shards plus a manifest. It takes the same reset_episode/append
+    calls as ReplayBuffer and stores them as a stream of reset and step records, so every frame is written
+    once. Shards are only cut at episode boundaries once they hold shard_records records, so that each shard
+    can be read on its own.
+    """
+
+    def __init__(self, path, num_sequences, state_shape, action_shape, shard_records=10000):
+        self.path = path
+        self.num_sequences = int(num_sequences)
+        self.state_shape = tuple(state_shape)
+        self.action_shape = tuple(action_shape)
+        self.shard_records = int(shard_records)
+        self.shards = []
+        self.shard = 0
+        self._records = []
+        self._zero_action = np.zeros(self.action_shape, dtype=np.float32)
+        os.makedirs(path, exist_ok=True)
+
+    def set_shard(self, shard):
+        """
+        Tag the following episodes with the given replay buffer shard.
+        """
+        self.shard = shard
+
+    def reset_episode(self, state):
+        self._records.append([RESET_EPISODE, state, self._zero_action, 0.0, False, False, self.shard])
+
+    def append(self, action, reward, done, next_state, episode_done):
+        self._records.append([STEP, next_state, action, reward, done, False, self.shard])
+        if episode_done:
+            self.end_episode()
+
+    def end_episode(self):
+        """
+        Mark the last step as the end of its episode.
+        """
+        self._records[-1][5] = True
+        if len(self._records) >= self.shard_records:
+            self._write_shard()
+
+    def _write_shard(self):
+        if not self._records:
+            return
+        kinds, states, actions, rewards, dones, episode_dones, shards = zip(*self._records)
+        data = dict(
+            kinds=np.array(kinds, dtype=np.uint8),
+            states=np.stack(states).astype(np.uint8, copy=False),
+            actions=np.stack(actions).astype(np.float32, copy=False),
+            rewards=np.array(rewards, dtype=np.float32),
+            dones=np.array(dones, dtype=bool),
+            episode_dones=np.array(episode_dones, dtype=bool),
+            shards=np.array(shards, dtype=np.int32),
+        )
+        # Shards are self-contained, so an unfinished episode is closed.
+        data["episode_dones"][-1] = True
+        name = f"shard-{len(self.shards):05d}.npz"
+        _write_atomic(self.path, name, lambda f: np.savez(f, **data))
+        self.shards.append(
+            dict(
+                file=name,
+                num_records=len(kinds),
+                num_steps=int((data["kinds"] == STEP).sum()),
+                num_episodes=int((data["kinds"] == RESET_EPISODE).sum()),
+            )
+        )
+        self._records = []
+
+    def close(self):
+        """
+        Write the pending records and the manifest, which is returned.
+        """
+        self._write_shard()
+        manifest = dict(
+            format_version=FORMAT_VERSION,
+            num_sequences=self.num_sequences,
+            state_shape=list(self.state_shape),
+            action_shape=list(self.action_shape),
+            num_records=sum(shard["num_records"] for shard in self.shards),
+            shards=self.shards,
+        )
+        _write_atomic(self.path, MANIFEST_FILE, lambda f: f.write(json.dumps(manifest, indent=4).encode()))
+        return manifest
+
+
+def _write_atomic(directory, name, write_fn):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        write_fn(f)
+    os.replace(tmp_path, os.path.join(directory, name))
+
+
+def _insertion_order(buffer):
+    # Stored sequences from oldest to newest, shard by shard for a sharded buffer.
+    if hasattr(buffer, "offsets"):
+        regions = zip(buffer.offsets, buffer.shard_sizes, buffer.shard_n, buffer.shard_p)
+    else:
+        regions = [(0, buffer.buffer_size, buffer._n, buffer._p)]
+    for shard, (offset, size, n, p) in enumerate(regions):
+        start = p if n == size else 0
+        for i in range(n):
+            yield shard, offset + (start + i) % size
+
+
+def export_buffer(buffer, path, shard_records=10000):
+    """
+    Export the sequences stored in a replay buffer. A sequence which continues the previous one (sharing all
+    but one frame) adds a single step, any other starts a new episode with all of its steps, so that loading
+    the dataset rebuilds the same sequences. Returns the manifest.
+    """
+    writer = DatasetWriter(path, buffer.num_sequences, buffer.state_shape, buffer.action_shape, shard_records)
+    action_, reward_, done_ = (x.cpu().numpy() for x in (buffer.action_, buffer.reward_, buffer.done_))
+    prev, prev_shard = None, None
+    for shard, idx in _insertion_order(buffer):
+        frames = buffer.state_[idx]
+        # Consecutive sequences of an episode share their frame arrays. Equal frames of different episodes, e.g.
+        # black frames after a reset, do not make a continuation.
+        if prev is not None and shard == prev_shard and all(a is b for a, b in zip(prev[1:], frames[:-1])):
+            writer.append(action_[idx, -1], reward_[idx, -1, 0], done_[idx, -1, 0], frames[-1], False)
+        else:
+            if prev is not None:
+                writer.end_episode()
+            writer.set_shard(shard)
+            writer.reset_episode(frames[0])
+            for t in range(buffer.num_sequences):
+                writer.append(action_[idx, t], reward_[idx, t, 0], done_[idx, t, 0], frames[t + 1], False)
+        prev, prev_shard = frames, shard
+    return writer.close()
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    assert manifest["format_version"] == FORMAT_VERSION, f"Unsupported dataset version: {manifest['format_version']}"
+    return manifest
+
+
+def _read_shard(path, name):
+    with np.load(os.path.join(path, name)) as f:
+        return {field: f[field] for field in (*RECORD_FIELDS, "shards")}
+
+
+def iterate_shards(path, num_workers=2, prefetch=2):
+    """
+    Yield the shards of a dataset in order as dicts of record arrays. Up to num_workers shards are read in
+    parallel and at most num_workers + prefetch shards are held in memory.
+    """
+    manifest = read_manifest(path)
+    files = [shard["file"] for shard in manifest["shards"]]
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        pending = deque()
+        for name in files:
+            pending.append(executor.submit(_read_shard, path, name))
+            if len(pending) >= max(1, num_workers) + prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def load_dataset(buffer, path, num_workers=2):
+    """
+    Fill a replay buffer (or anything with its reset_episode/append interface) with a dataset, streaming over
+    the shards. Returns the number of records loaded. A sharded buffer is left routing to the last shard loaded.
+    """
+    manifest = read_manifest(path)
+    assert tuple(manifest["state_shape"]) == tuple(buffer.state_shape), "Observation shape does not match."
+    num_shards = getattr(buffer, "num_shards", None)
+    num_records = 0
+    for data in iterate_shards(path, num_workers):
+        for shard in np.unique(data["shards"]):
+            keep = data["shards"] == shard
+            if hasattr(buffer, "set_shard"):
+                assert num_shards is None or shard < num_shards, (
+                    f"The dataset has episodes of shard {shard}, but the replay buffer only has {num_shards} "
+                    "shards. Use as many environment variants as the dataset was collected with."
+                )
+                buffer.set_shard(int(shard))
+            add_episodes(buffer, *(data[field][keep] for field in RECORD_FIELDS))
+        num_records += len(data["kinds"])
+    return num_records
+
+
+def iterate_latent_batches(path, batch_size, device, num_workers=2, shuffle_shards=4, prefetch=2):
+    """
+    Yield latent model batches (state_, action_, reward_, done_) straight from a dataset without a replay
+    buffer. Sequences of shuffle_shards consecutive shards are shuffled together. Each shard's records are
+    held once and batches are gathered from them by the start records of their sequences, so memory is bounded
+    by that many shards (plus those still holding leftover sequences). Sequences left over at the end which do
+    not fill a batch are dropped. With prefetch > 0, up to that many batches are assembled ahead in a
+    background thread.
+    """
+    batches = _iterate_latent_batches(path, batch_size, device, num_workers, shuffle_shards)
+    return prefetch_iterator(batches, prefetch) if prefetch > 0 else batches
+
+
+def _iterate_latent_batches(path, batch_size, device, num_workers, shuffle_shards):
+    num_sequences = read_manifest(path)["num_sequences"]
+    # Shards with the start records of their sequences not yet yielded.
+    window, num_new = [], 0
+    for data in iterate_shards(path, num_workers):
+        starts = _sequence_starts(data, num_sequences)
+        if len(starts) == 0:
+            continue
+        window.append((data, starts))
+        num_new += 1
+        if num_new >= shuffle_shards:
+            window = yield from _window_batches(window, batch_size, num_sequences, device)
+            num_new = 0
+    if window:
+        yield from _window_batches(window, batch_size, num_sequences, device)
+
+
+def _window_batches(window, batch_size, num_sequences, device):
+    # Yield the full batches of the window's sequences in random order and return the leftover ones.
+    shard_ = np.concatenate([np.full(len(starts), i) for i, (_, starts) in enumerate(window)])
+    start_ = np.concatenate([starts for _, starts in window])
+    order = np.random.permutation(len(start_))
+    num_full = len(order) // batch_size
+    steps = np.arange(num_sequences + 1)
+    for b in range(num_full):
+        batch = order[b * batch_size : (b + 1) * batch_size]
+        parts = []
+        for i in np.unique(shard_[batch]):
+            data = window[i][0]
+            # Records of the frames, and of the actions, rewards and dones following the first frame.
+            idxes = start_[batch][shard_[batch] == i][:, None] + steps
+            parts.append(
+                (
+                    data["states"][idxes],
+                    data["actions"][idxes[:, 1:]],
+                    data["rewards"][idxes[:, 1:], None],
+                    data["dones"][idxes[:, 1:], None].astype(np.float32),
+                )
+            )
+        frames, actions, rewards, dones = (np.concatenate(x) for x in zip(*parts))
+        state_ = torch.tensor(frames, dtype=torch.uint8, device=device).float().div_(255.0)
+        yield (state_, *(torch.as_tensor(x, device=device) for x in (actions, rewards, dones)))
+    rest = order[num_full * batch_size :]
+    return [(window[i][0], start_[rest][shard_[rest] == i]) for i in np.unique(shard_[rest])]
+
+
+def _sequence_starts(data, num_sequences):
+    # First records of all sequences of a shard, as a replay buffer builds them: num_sequences + 1 consecutive
+    # records of one episode, i.e. all but the first are steps and none but the last ends the episode.
+    kinds, episode_dones = data["kinds"], data["episode_dones"]
+    num_starts = len(kinds) - num_sequences
+    if num_starts <= 0:
+        return np.zeros(0, dtype=np.int64)
+    valid = np.ones(num_starts, dtype=bool)
+    for t in range(num_sequences):
+        valid &= kinds[t + 1 : t + 1 + num_starts] == STEP
+        valid &= ~episode_dones[t : t + num_starts]
+    return np.flatnonzero(valid)
@@ -0,0 +1,73 @@
+import torch
+import torch.distributed as dist
+
+
+def init_learner(rank, world_size, init_method="tcp://127.0.0.1:29500", backend="gloo"):
+    """
+    Join the process group of data-parallel learners.
+    """
+    dist.init_process_group(backend=backend, init_method=init_method, rank=rank, world_size=world_size)
+
+
+def close_learner():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def broadcast_parameters(params, src=0):
+    """
+    Overwrite the given parameters with those of the source rank so all learners start from the same weights.
+    """
+    params = [p for p in params]
+    flat = torch.cat([p.data.reshape(-1) for p in params])
+    dist.broadcast(flat, src=src)
+    offset = 0
+    for p in params:
+        n = p.numel()
+        p.data.copy_(flat[offset : offset + n].view_as(p))
+        offset += n
+
+
+def all_reduce_gradients(params):
+    """
+    Average the gradients of the given parameters over all learners. The gradients are packed into a single
+    buffer so that there is one all-reduce per optimizer step.
+    """
+    params = [p for p in params if p.requires_grad]
+    grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in params]
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat.div_(dist.get_world_size())
+    offset = 0
+    for p in params:
+        n = p.numel()
+        if p.grad is None:
+            p.grad = torch.empty_like(p)
+        p.grad.copy_(flat[offset : offset + n].view_as(p))
+        offset += n
+
+
+def all_reduce_value(value, op="mean"):
+    """
+    Reduce a python scalar over all learners with "mean", "sum", "min" or "max".
+    """
+    if not is_distributed():
+        return value
+    ops = {"mean": dist.ReduceOp.SUM, "sum": dist.ReduceOp.SUM, "min": dist.ReduceOp.MIN, "max": dist.ReduceOp.MAX}
+    tensor = torch.tensor([float(value)], dtype=torch.float64)
+    dist.all_reduce(tensor, op=ops[op])
+    if op == "mean":
+        tensor.div_(dist.get_world_size())
+    return tensor.item()
@@ -1,6 +1,8 @@
 import dmc2gym
 import gymnasium as gym
 
+from slac_pytorch.environments.wrappers import ActionRepeatWrapper
+
 # gym.logger.set_level(40) # remove this for last version of gym
 
 
@@ -29,6 +31,8 @@ def make_gym(env, action_repeat, max_episode_steps=None, autoreset=False, render
         **environment_kwargs
     )
     
+    if action_repeat > 1:
+        env = ActionRepeatWrapper(env, action_repeat)
     setattr(env, 'action_repeat', action_repeat)
     
     return env
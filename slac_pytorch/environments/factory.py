@@ -0,0 +1,99 @@
+import copy
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree as ET
+
+from slac_pytorch.common.xml_manager import XML
+from slac_pytorch.env import make_dmc, make_gym
+from slac_pytorch.environments.pool import PrewarmedEnv
+from slac_pytorch.environments.wrappers import AntImageWrapper
+
+
+def make_env(args, agent_path, from_pixels=True, universe=None):
+    """
+    Build one environment of the given (by default the configured) universe from the given MJCF file.
+    """
+    if (universe or args.universe) == 'gym':
+        env = make_gym(
+            env=args.domain_name,
+            action_repeat=args.action_repeat,
+            render_mode=args.render_mode,
+            environment_kwargs=dict(
+                xml_file=agent_path
+            )
+        )
+        # Wrap the environment with our custom wrapper
+        return AntImageWrapper(env, image_size=(64, 64))
+
+    return make_dmc(
+        domain_name=args.domain_name,
+        task_name=args.task_name,
+        action_repeat=args.action_repeat,
+        from_pixels=from_pixels,
+        image_size=64,
+        environment_kwargs=dict(
+            agent_path=agent_path
+        )
+    )
+
+
+class EnvVariantFactory:
+    """
+    Builds environment variants with modified mass and friction.
+
+    The base MJCF is parsed once. Each variant is written to a file named after the hash of its content, which
+    is reused when it already exists, so concurrent runs never rewrite each other's agent files. The files are
+    stored next to the base file by default so that its relative includes keep resolving.
+    """
+
+    def __init__(self, args, cache_dir=None, num_workers=1, universe=None):
+        self.args = args
+        self.universe = universe
+        self.agent_path = args.agent_path
+        self.cache_dir = cache_dir or os.path.dirname(os.path.abspath(self.agent_path))
+        self.num_workers = max(1, int(num_workers))
+        self.xml = XML()
+        self._tree = ET.parse(self.agent_path)
+
+    def agent_file(self, values):
+        """
+        Path to the MJCF file of the variant with the given values, written on first use.
+        """
+        tree = copy.deepcopy(self._tree)
+        self.xml.modify_tree(tree, values)
+        data = ET.tostring(tree.getroot())
+
+        stem = os.path.splitext(os.path.basename(self.agent_path))[0]
+        path = os.path.join(self.cache_dir, f"{stem}.{hashlib.sha256(data).hexdigest()[:16]}.xml")
+        if not os.path.exists(path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write atomically, so that a concurrent run either sees no file or the complete one.
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return path
+
+    def make(self, values, from_pixels=True):
+        return make_env(self.args, self.agent_file(values), from_pixels, self.universe)
+
+    def make_all(self, variants, from_pixels=True, prewarm=False):
+        """
+        Build one environment per variant, constructing them concurrently. The instances own native simulator
+        and rendering handles which cannot be sent back from worker processes, so the workers are threads.
+
+        With prewarm, each variant is a PrewarmedEnv whose two instances each run on their own thread.
+        """
+        paths = [self.agent_file(values) for values in variants]
+
+        def build(path):
+            if prewarm:
+                return PrewarmedEnv(lambda: make_env(self.args, path, from_pixels, self.universe))
+            return make_env(self.args, path, from_pixels, self.universe)
+
+        if self.num_workers == 1:
+            return [build(path) for path in paths]
+        with ThreadPoolExecutor(max_workers=min(self.num_workers, len(paths))) as executor:
+            return list(executor.map(build, paths))
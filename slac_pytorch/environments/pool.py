@@ -0,0 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PrewarmedEnv:
+    """
+    Environment which keeps a spare, already reset instance of the same variant warm in a background worker.
+
+    reset() swaps the spare in and returns its first observation immediately, while the finished instance is
+    reset in the background for the episode after. Seeding stays deterministic: after reset(seed=s), the n-th
+    following episode is reset with seed s + n no matter when the background reset ran.
+
+    Each instance is built, reset, stepped, rendered and closed on its own dedicated thread. Renderers such as
+    gymnasium's MujocoRenderer bind their GL context to the thread of the first render and do not make it
+    current again, so an instance must never render on two threads.
+    """
+
+    def __init__(self, make_fn):
+        self._threads = [ThreadPoolExecutor(max_workers=1) for _ in range(2)]
+        self._envs = [thread.submit(make_fn).result() for thread in self._threads]
+        self._active = 0
+        self._spare = None
+        self._seed = None
+
+    @property
+    def env(self):
+        return self._envs[self._active]
+
+    @property
+    def action_space(self):
+        # Always the space of the first instance, so that random actions come from a single generator.
+        return self._envs[0].action_space
+
+    @property
+    def observation_space(self):
+        return self._envs[0].observation_space
+
+    @property
+    def spec(self):
+        return self._envs[0].spec
+
+    @property
+    def action_repeat(self):
+        return self._envs[0].action_repeat
+
+    def _next_seed(self):
+        if self._seed is None:
+            return None
+        self._seed += 1
+        return self._seed
+
+    def _call(self, idx, fn, *args, **kwargs):
+        # Run fn on the thread of instance idx.
+        return self._threads[idx].submit(fn, *args, **kwargs)
+
+    def _prewarm(self, idx):
+        self._spare = self._call(idx, self._envs[idx].reset, seed=self._next_seed())
+
+    def reset(self, seed=None, **kwargs):
+        if seed is not None or self._spare is None:
+            # (Re)start the seed sequence with a synchronous reset of the active instance.
+            if self._spare is not None:
+                self._spare.result()
+            self._seed = seed
+            result = self._call(self._active, self.env.reset, seed=seed, **kwargs).result()
+        else:
+            result = self._spare.result()
+            self._active = 1 - self._active
+        self._prewarm(1 - self._active)
+        return result
+
+    def step(self, action):
+        return self._call(self._active, self.env.step, action).result()
+
+    def render(self, *args, **kwargs):
+        return self._call(self._active, self.env.render, *args, **kwargs).result()
+
+    def close(self):
+        if self._spare is not None:
+            self._spare.result()
+        for idx, env in enumerate(self._envs):
+            self._call(idx, env.close).result()
+        for thread in self._threads:
+            thread.shutdown()
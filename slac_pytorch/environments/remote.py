@@ -0,0 +1,187 @@
+import socket
+import socketserver
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+from gymnasium import spaces
+
+from slac_pytorch.common.protocol import connect, decode_json, encode_json, recv_message, send_message
+from slac_pytorch.environments.factory import EnvVariantFactory
+
+MAKE, RESET, STEP, CLOSE, OK, ERROR, RELEASE = range(7)
+
+
+class _EnvHandler(socketserver.BaseRequestHandler):
+    """
+    Serves one client. The client first asks for its environment variants, then resets and steps them in
+    batches addressed by environment index. Instances are closed when released or when the client leaves.
+    """
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.envs = []
+
+    def handle(self):
+        while True:
+            try:
+                op, arrays = recv_message(self.request)
+            except ConnectionError:
+                return
+            if op == CLOSE:
+                send_message(self.request, OK)
+                return
+            try:
+                reply = getattr(self, {MAKE: "make", RESET: "reset", STEP: "step", RELEASE: "release"}[op])(*arrays)
+            except Exception as e:
+                send_message(self.request, ERROR, [encode_json(repr(e))])
+            else:
+                send_message(self.request, OK, reply)
+
+    def finish(self):
+        self.release(range(len(self.envs)))
+
+    def make(self, request):
+        request = decode_json(request)
+        args = self.server.args
+        factory = EnvVariantFactory(
+            args, cache_dir=args.env_cache_dir, num_workers=args.env_workers, universe=request["universe"]
+        )
+        self.envs = factory.make_all(request["variants"], request["from_pixels"], prewarm=args.env_prewarm)
+        info, bounds = [], []
+        for env in self.envs:
+            spec = getattr(env, "spec", None)
+            info.append(
+                dict(
+                    max_episode_steps=getattr(spec, "max_episode_steps", None),
+                    action_repeat=getattr(env, "action_repeat", 1),
+                    observation_dtype=np.dtype(env.observation_space.dtype).str,
+                )
+            )
+            for space in (env.action_space, env.observation_space):
+                bounds += [np.asarray(space.low), np.asarray(space.high)]
+        return [encode_json(info)] + bounds
+
+    def reset(self, idxes, seeds):
+        states = [self.envs[i].reset(seed=None if s < 0 else int(s))[0] for i, s in zip(idxes, seeds)]
+        return [np.stack(states)]
+
+    def step(self, idxes, actions):
+        states, rewards, terminated, truncated = [], [], [], []
+        for i, action in zip(idxes, actions):
+            state, reward, term, trunc, _ = self.envs[i].step(action)
+            states.append(state)
+            rewards.append(reward)
+            terminated.append(term)
+            truncated.append(trunc)
+        return [np.stack(states), np.array(rewards, np.float64), np.array(terminated), np.array(truncated)]
+
+    def release(self, idxes):
+        for i in idxes:
+            env, self.envs[i] = self.envs[i], None
+            if env is not None:
+                env.close()
+        return []
+
+
+class EnvServer(socketserver.ThreadingTCPServer):
+    """
+    Hosts environment variants for remote clients, one thread and one set of instances per connection.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, args):
+        host, port = address.rsplit(":", 1)
+        super().__init__((host, int(port)), _EnvHandler)
+        self.args = args
+
+
+class EnvClient:
+    """
+    Connection to an EnvServer. reset() and step() act on a batch of environments in one round trip.
+    """
+
+    def __init__(self, address):
+        self.sock = connect(address)
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def _call(self, op, arrays=()):
+        with self._lock:
+            send_message(self.sock, op, arrays)
+            status, reply = recv_message(self.sock)
+        if status == ERROR:
+            raise RuntimeError(f"Environment server error: {decode_json(reply[0])}")
+        return reply
+
+    def make(self, variants, from_pixels=True, universe=None):
+        """
+        Build the given variants on the server and return one RemoteEnv per variant.
+        """
+        request = dict(variants=list(variants), from_pixels=from_pixels, universe=universe)
+        reply = self._call(MAKE, [encode_json(request)])
+        info, bounds = decode_json(reply[0]), reply[1:]
+        envs = []
+        for i, env_info in enumerate(info):
+            act_low, act_high, obs_low, obs_high = bounds[4 * i : 4 * i + 4]
+            action_space = spaces.Box(act_low, act_high, dtype=act_low.dtype)
+            observation_space = spaces.Box(obs_low, obs_high, dtype=np.dtype(env_info["observation_dtype"]))
+            envs.append(RemoteEnv(self, i, action_space, observation_space, env_info))
+        return envs
+
+    def reset(self, idxes, seeds=None):
+        seeds = [-1 if s is None else s for s in (seeds or [None] * len(idxes))]
+        (states,) = self._call(RESET, [np.asarray(idxes, np.int32), np.asarray(seeds, np.int64)])
+        return states
+
+    def step(self, idxes, actions):
+        states, rewards, terminated, truncated = self._call(
+            STEP, [np.asarray(idxes, np.int32), np.asarray(actions, np.float32)]
+        )
+        return states, rewards, terminated, truncated
+
+    def release(self, idxes):
+        """
+        Close the given environments on the server.
+        """
+        self._call(RELEASE, [np.asarray(idxes, np.int32)])
+
+    def close(self):
+        """
+        Close the connection, which also closes the remaining environments on the server.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._call(CLOSE)
+        self.sock.close()
+
+
+class RemoteEnv:
+    """
+    Drop-in environment whose simulation runs on an EnvServer.
+    """
+
+    def __init__(self, client, idx, action_space, observation_space, info):
+        self.client = client
+        self.idx = idx
+        self.action_space = action_space
+        self.observation_space = observation_space
+        self.spec = SimpleNamespace(max_episode_steps=info["max_episode_steps"])
+        self.action_repeat = info["action_repeat"]
+        self._closed = False
+
+    def reset(self, seed=None):
+        return self.client.reset([self.idx], [seed])[0], {}
+
+    def step(self, action):
+        states, rewards, terminated, truncated = self.client.step([self.idx], [action])
+        return states[0], rewards[0].item(), bool(terminated[0]), bool(truncated[0]), {}
+
+    def close(self):
+        # The server has already closed every instance of a closed client.
+        if not (self._closed or self.client.closed):
+            self.client.release([self.idx])
+        self._closed = True
@@ -1,11 +1,130 @@
+import os
+import queue
+import threading
+
 import gymnasium as gym
 import numpy as np
+import torch
 from gymnasium import spaces
+from torch.nn import functional as F
+
+def area_matrix(in_size, out_size):
+    """
+    Box filter resizing a 1D signal of in_size to out_size as a (out_size, in_size) matrix, where output pixel i
+    averages the input interval [i * scale, (i + 1) * scale).
+    """
+    scale = in_size / out_size
+    edges = np.arange(out_size + 1) * scale
+    j = np.arange(in_size)[None, :]
+    overlap = np.minimum(edges[1:, None], j + 1) - np.maximum(edges[:-1, None], j)
+    return (np.clip(overlap, 0, None) / scale).astype(np.float32)
+
+
+def matrix_taps(matrix):
+    """
+    Sparse form of a banded resize matrix: output i is sum_k weights[i, k] * x[idxes[i, k]].
+    """
+    nonzero = matrix > 0
+    taps = nonzero.argmax(axis=1)[:, None] + np.arange(nonzero.sum(axis=1).max())
+    idxes = np.minimum(taps, matrix.shape[1] - 1)
+    weights = np.take_along_axis(matrix, idxes, axis=1) * (taps < matrix.shape[1])
+    return idxes, weights.astype(np.float32)
+
+
+class ImageResizer:
+    """
+    Resizes HWC uint8 frames (or batches of them) to CHW uint8 observations.
+
+    "bilinear" is antialiased bilinear interpolation, which runs on the uint8 SIMD path of torch. "area" is
+    an exact box filter computed as a few weighted row/column gathers, with preallocated intermediate buffers.
+    """
+
+    def __init__(self, in_shape, out_size, interpolation="bilinear"):
+        assert interpolation in ("bilinear", "area"), f"Unknown interpolation: {interpolation}"
+        self.in_height, self.in_width, self.channels = in_shape
+        self.out_height, self.out_width = out_size
+        self.interpolation = interpolation
+        self._identity = (self.in_height, self.in_width) == (self.out_height, self.out_width)
+        if interpolation == "area":
+            self._row_idxes, self._row_weights = matrix_taps(area_matrix(self.in_height, self.out_height))
+            self._cols_t = np.ascontiguousarray(area_matrix(self.in_width, self.out_width).T)
+        self._buffers = {}
+
+    def __call__(self, image, out=None):
+        """
+        Resize one (H, W, C) frame, writing into out of shape (C, h, w) when given.
+        """
+        if out is None:
+            out = np.empty((self.channels, self.out_height, self.out_width), dtype=np.uint8)
+        self.resize_batch(image[None], out[None])
+        return out
+
+    def resize_batch(self, images, out=None):
+        """
+        Resize (N, H, W, C) frames from vectorized environments at once, writing into out of shape
+        (N, C, h, w) when given.
+        """
+        n = images.shape[0]
+        if out is None:
+            out = np.empty((n, self.channels, self.out_height, self.out_width), dtype=np.uint8)
+        if self._identity:
+            out[...] = images.transpose(0, 3, 1, 2)
+        elif self.interpolation == "bilinear":
+            # NCHW view of the NHWC frames, i.e. channels-last memory without a copy.
+            frames = torch.from_numpy(np.ascontiguousarray(images)).permute(0, 3, 1, 2)
+            resized = F.interpolate(frames, size=(self.out_height, self.out_width), mode="bilinear", antialias=True)
+            torch.from_numpy(out).copy_(resized)
+        else:
+            self._resize_area(images, out)
+        return out
+
+    def _resize_area(self, images, out):
+        n = images.shape[0]
+        if n not in self._buffers:
+            self._buffers[n] = (
+                np.empty((n, self.out_height, 1, self.in_width * self.channels), dtype=np.float32),
+                np.empty((n, self.out_height, self.channels, self.out_width), dtype=np.float32),
+            )
+        rows, result = self._buffers[n]
+
+        # Filter along the height: (h, 1, K) @ (N, h, K, W * C) -> (N, h, 1, W * C).
+        taps = images.reshape(n, self.in_height, -1)[:, self._row_idxes].astype(np.float32)
+        np.matmul(self._row_weights[:, None, :], taps, out=rows)
+        # Filter along the width: (N, h, C, W) @ (W, w) -> (N, h, C, w).
+        rows = rows.reshape(n, self.out_height, self.in_width, self.channels).transpose(0, 1, 3, 2)
+        np.matmul(rows, self._cols_t, out=result)
+        np.rint(result, out=result)
+        out[...] = result.transpose(0, 2, 1, 3)
+
+
+class ActionRepeatWrapper(gym.Wrapper):
+    """
+    Repeats every action action_repeat times and sums the rewards, stopping early when the episode ends.
+    Only the observation of the last substep is returned, so an image wrapper on top of this one renders
+    once per action instead of once per physics step.
+    """
+
+    def __init__(self, env, action_repeat):
+        super().__init__(env)
+        self.action_repeat = action_repeat
+
+    def step(self, action):
+        total_reward = 0.0
+        for _ in range(self.action_repeat):
+            observation, reward, terminated, truncated, info = self.env.step(action)
+            total_reward += reward
+            if terminated or truncated:
+                break
+        return observation, total_reward, terminated, truncated, info
+
 
 class AntImageWrapper(gym.Wrapper):
-    def __init__(self, env, image_size=(84, 84)):
+    def __init__(self, env, image_size=(84, 84), interpolation="bilinear"):
         super().__init__(env)
         self.image_size = image_size
+        self.interpolation = interpolation
+        # Built on the first frame, once the render size is known.
+        self._resizer = None
         
         # Update the observation space to be an image
         self.observation_space = spaces.Box(low=0, high=255, shape=(3, image_size[0], image_size[1]), dtype=np.uint8)
@@ -18,17 +137,194 @@ class AntImageWrapper(gym.Wrapper):
         observation, reward, terminated, truncated, info = self.env.step(action)
         return self._get_image_observation(), reward, terminated, truncated, info
 
-    def _get_image_observation(self):
+    def _get_image_observation(self, out=None):
         # Render the environment
         img = self.env.render()
         
         # Resize the image to the desired dimensions
-        img = self._resize_image(img)
+        img = self._resize_image(img, out)
         
         return img
 
-    def _resize_image(self, image):
-        # Implement image resizing here
-        # You can use libraries like PIL or cv2 for this
-        # For simplicity, let's assume we're using a placeholder function
-        return np.zeros((3, *self.image_size), dtype=np.uint8)
+    def _resize_image(self, image, out=None):
+        """
+        Resize a rendered (H, W, 3) frame to a (3, *image_size) uint8 observation. A fresh array is returned
+        unless out is given, since observations are kept by reference in the replay buffer.
+        """
+        if self._resizer is None:
+            self._resizer = ImageResizer(image.shape, self.image_size, self.interpolation)
+        return self._resizer(image, out)
+
+
+class VideoRecorder:
+    """
+    Records every every_n_episodes-th episode to video_dir. Frames are either the rendered images or, with
+    source="observation", the (C, H, W) image observations. They are handed through a queue of at most
+    max_queue frames to a background thread, which streams them to an mp4 file (video_format="mp4", needs
+    imageio with ffmpeg) or to compressed .npz shards of shard_frames frames (video_format="npz"). Memory
+    use is bounded by these sizes however long the episodes are, and the episode waits while the queue is
+    full.
+
+    Like PrewarmedEnv, it delegates to the environment instead of being a gym.Wrapper, so that it also wraps
+    a PrewarmedEnv or a RemoteEnv, which are not gymnasium environments.
+    """
+
+    def __init__(
+        self,
+        env,
+        video_dir,
+        every_n_episodes=1,
+        source="render",
+        video_format="mp4",
+        fps=30,
+        max_queue=64,
+        shard_frames=500,
+    ):
+        self.env = env
+        assert source in ("render", "observation"), f"Unknown frame source: {source}"
+        assert video_format in ("mp4", "npz"), f"Unknown video format: {video_format}"
+        self.video_dir = video_dir
+        self.every_n_episodes = max(1, int(every_n_episodes))
+        self.source = source
+        self.video_format = video_format
+        self.fps = fps
+        self.shard_frames = int(shard_frames)
+        self.num_episodes = 0
+        self.recording = False
+        self._frames = queue.Queue(maxsize=max_queue)
+        self._error = None
+        os.makedirs(video_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    @property
+    def action_space(self):
+        return self.env.action_space
+
+    @property
+    def observation_space(self):
+        return self.env.observation_space
+
+    @property
+    def spec(self):
+        return self.env.spec
+
+    @property
+    def action_repeat(self):
+        return self.env.action_repeat
+
+    def reset(self, **kwargs):
+        observation, info = self.env.reset(**kwargs)
+        self.recording = self.num_episodes % self.every_n_episodes == 0
+        self.num_episodes += 1
+        if self.recording:
+            self._put(("episode", f"episode-{self.num_episodes - 1:06d}"))
+            self._record(observation)
+        return observation, info
+
+    def step(self, action):
+        observation, reward, terminated, truncated, info = self.env.step(action)
+        if self.recording:
+            self._record(observation)
+            if terminated or truncated:
+                # Finish the file right away rather than at the next recorded episode.
+                self._put(("end", None))
+        return observation, reward, terminated, truncated, info
+
+    def render(self, *args, **kwargs):
+        return self.env.render(*args, **kwargs)
+
+    def _record(self, observation):
+        if self.source == "render":
+            frame = np.asarray(self.env.render(), dtype=np.uint8)
+        else:
+            frame = np.asarray(observation, dtype=np.uint8).transpose(1, 2, 0)
+        self._put(("frame", frame))
+
+    def _put(self, item):
+        if self._error is not None:
+            raise RuntimeError("Video writer failed.") from self._error
+        self._frames.put(item)
+
+    def _write(self):
+        writer = None
+        try:
+            while True:
+                kind, value = self._frames.get()
+                if kind != "frame" and writer is not None:
+                    writer.close()
+                    writer = None
+                if kind == "close":
+                    return
+                if kind == "episode":
+                    writer = self._open(value)
+                elif kind == "frame":
+                    writer.append(value)
+                self._frames.task_done()
+        except Exception as e:
+            self._error = e
+            self._frames.task_done()
+            # Keep draining, so that the episode does not block on the full queue.
+            while self._frames.get()[0] != "close":
+                self._frames.task_done()
+        finally:
+            self._frames.task_done()
+
+    def _open(self, name):
+        path = os.path.join(self.video_dir, name)
+        if self.video_format == "npz":
+            return _FrameShardWriter(path, self.shard_frames)
+        # Only needed when recording mp4 files.
+        import imageio
+
+        return _ImageioWriter(imageio.get_writer(path + ".mp4", fps=self.fps, macro_block_size=1))
+
+    def flush(self):
+        """
+        Wait until the queued frames are written.
+        """
+        self._frames.join()
+        if self._error is not None:
+            raise RuntimeError("Video writer failed.") from self._error
+
+    def close(self):
+        self._frames.put(("close", None))
+        self._thread.join()
+        self.env.close()
+
+
+class _ImageioWriter:
+    def __init__(self, writer):
+        self.writer = writer
+
+    def append(self, frame):
+        self.writer.append_data(frame)
+
+    def close(self):
+        self.writer.close()
+
+
+class _FrameShardWriter:
+    """
+    Writes frames to numbered compressed .npz shards of at most shard_frames frames.
+    """
+
+    def __init__(self, path, shard_frames):
+        self.path = path
+        self.shard_frames = max(1, shard_frames)
+        self.frames = []
+        self.num_shards = 0
+
+    def append(self, frame):
+        self.frames.append(frame)
+        if len(self.frames) >= self.shard_frames:
+            self._flush()
+
+    def _flush(self):
+        if self.frames:
+            np.savez_compressed(f"{self.path}-{self.num_shards:04d}.npz", frames=np.stack(self.frames))
+            self.frames = []
+            self.num_shards += 1
+
+    def close(self):
+        self._flush()
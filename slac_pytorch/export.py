@@ -0,0 +1,188 @@
+import copy
+import json
+from time import perf_counter
+
+import numpy as np
+import torch
+from torch import nn
+from torch.ao import quantization
+
+# Name of the metadata stored inside the TorchScript archive.
+METADATA_FILE = "metadata.json"
+QUANTIZATION_MODES = ("none", "dynamic", "static")
+
+
+class _Encoder(nn.Module):
+    """
+    Eager copy of the convolutional encoder, with stubs marking where static quantization starts and ends.
+    """
+
+    def __init__(self, layers):
+        super().__init__()
+        self.quant = quantization.QuantStub()
+        self.net = nn.Sequential(*layers)
+        self.dequant = quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.net(self.quant(x)))
+
+
+class FrozenPolicy(nn.Module):
+    """
+    Deterministic policy on raw inputs: uint8 frame stacks of shape (B, S, C, H, W) and the flattened
+    S - 1 previous actions of shape (B, (S - 1) * |A|). Only depends on torch, so it can be scripted.
+    """
+
+    def __init__(self, encoder, actor):
+        super().__init__()
+        self.encoder = _Encoder(_encoder_layers(encoder))
+        self.actor = nn.Sequential(*(_eager_layer(layer) for layer in actor.net))
+
+    def forward(self, frames, actions):
+        B, S, C, H, W = frames.shape
+        x = frames.reshape(B * S, C, H, W).float().div(255.0)
+        feature = self.encoder(x).reshape(B, -1)
+        mean = torch.chunk(self.actor(torch.cat([feature, actions], dim=1)), 2, dim=-1)[0]
+        return torch.tanh(mean)
+
+
+def _encoder_layers(encoder):
+    if hasattr(encoder, "net"):
+        return [_eager_layer(layer) for layer in encoder.net]
+    # ObsEncoder applies its activation after every convolution.
+    convs = (encoder.conv1, encoder.conv2, encoder.conv3, encoder.conv4)
+    return [_eager_layer(layer) for conv in convs for layer in (conv, encoder.leaky_relu)]
+
+
+_LAYERS = dict(
+    Conv2d=lambda m: nn.Conv2d(
+        m.in_channels,
+        m.out_channels,
+        m.kernel_size,
+        m.stride,
+        m.padding,
+        m.dilation,
+        m.groups,
+        m.bias is not None,
+        m.padding_mode,
+    ),
+    Linear=lambda m: nn.Linear(m.in_features, m.out_features, m.bias is not None),
+    LeakyReLU=lambda m: nn.LeakyReLU(m.negative_slope),
+    ReLU=lambda m: nn.ReLU(),
+)
+
+
+def _eager_layer(layer):
+    # Scripted layers are rebuilt as eager copies, which the quantization passes can replace.
+    if not isinstance(layer, torch.jit.RecursiveScriptModule):
+        return copy.deepcopy(layer).cpu()
+    assert layer.original_name in _LAYERS, f"Cannot export {layer.original_name} layers."
+    eager = _LAYERS[layer.original_name](layer)
+    eager.load_state_dict({k: v.cpu() for k, v in layer.state_dict().items()})
+    return eager
+
+
+def policy_inputs(state_, action_, num_sequences):
+    """
+    Policy inputs of the first num_sequences steps of latent model batches (state_, action_).
+    """
+    frames = state_[:, :num_sequences].mul(255.0).round_().to(torch.uint8).cpu()
+    actions = action_[:, : num_sequences - 1].reshape(len(action_), -1).float().cpu()
+    return frames, actions
+
+
+def _quantize(policy, mode, calibration):
+    # Linear layers are quantized dynamically in both modes, convolutions statically with calibration data.
+    if mode == "static":
+        policy.encoder.qconfig = quantization.get_default_qconfig(torch.backends.quantized.engine)
+        quantization.prepare(policy.encoder, inplace=True)
+        with torch.no_grad():
+            for frames, actions in calibration:
+                policy(frames, actions)
+        quantization.convert(policy.encoder, inplace=True)
+    return quantization.quantize_dynamic(policy, {nn.Linear}, dtype=torch.qint8)
+
+
+def _benchmark(policy, frames, actions, num_steps):
+    # Median latency of single actions in milliseconds.
+    times = []
+    with torch.inference_mode():
+        for _ in range(10):
+            policy(frames, actions)
+        for _ in range(num_steps):
+            start = perf_counter()
+            policy(frames, actions)
+            times.append(perf_counter() - start)
+    return float(np.median(times) * 1000.0)
+
+
+def export_policy(encoder, actor, path, num_sequences, batches, quantization_mode="dynamic", benchmark_steps=200):
+    """
+    Export the encoder and actor as a frozen TorchScript policy for CPU inference, optionally quantized to
+    int8. batches are latent model batches (state_, action_), e.g. sampled from the replay buffer, used to
+    calibrate static quantization and to measure the error of the exported actions. Returns a report with
+    the action MSE versus the fp32 policy and the speedup of single actions, which is stored in the archive.
+    """
+    assert quantization_mode in QUANTIZATION_MODES, f"Unknown quantization mode: {quantization_mode}"
+    inputs = [policy_inputs(state_, action_, num_sequences) for state_, action_ in batches]
+    assert inputs, "Need at least one batch of replay frames."
+
+    reference = FrozenPolicy(encoder, actor).cpu().eval()
+    policy = copy.deepcopy(reference)
+    if quantization_mode != "none":
+        policy = _quantize(policy, quantization_mode, inputs)
+    reference = torch.jit.freeze(torch.jit.script(reference))
+    policy = torch.jit.freeze(torch.jit.script(policy.eval()))
+
+    with torch.inference_mode():
+        errors = [(policy(*x) - reference(*x)).pow(2).mean().item() for x in inputs]
+    frames, actions = (x[:1] for x in inputs[0])
+    fp32_ms = _benchmark(reference, frames, actions, benchmark_steps)
+    export_ms = _benchmark(policy, frames, actions, benchmark_steps)
+    report = dict(
+        quantization=quantization_mode,
+        quantized_engine=torch.backends.quantized.engine,
+        num_sequences=num_sequences,
+        frame_shape=list(frames.shape[2:]),
+        action_dim=actions.shape[1] // (num_sequences - 1),
+        action_mse=float(np.mean(errors)),
+        fp32_latency_ms=fp32_ms,
+        latency_ms=export_ms,
+        speedup=fp32_ms / export_ms,
+    )
+    torch.jit.save(policy, path, _extra_files={METADATA_FILE: json.dumps(report)})
+    return report
+
+
+class PolicyRunner:
+    """
+    Runs an exported policy. Only needs torch, so it also works without the training code's dependencies.
+    """
+
+    def __init__(self, path, num_threads=None):
+        extra_files = {METADATA_FILE: ""}
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.policy = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+        self.metadata = json.loads(extra_files[METADATA_FILE])
+        if self.metadata["quantization"] != "none":
+            torch.backends.quantized.engine = self.metadata["quantized_engine"]
+        self.num_sequences = self.metadata["num_sequences"]
+        self._no_actions = torch.zeros(1, (self.num_sequences - 1) * self.metadata["action_dim"])
+
+    def act(self, frames, actions=None):
+        """
+        Actions for uint8 frame stacks of shape (S, C, H, W), or (B, S, C, H, W) for a batch, and the S - 1
+        previous actions of each stack (zeros if not given, as at the start of an episode).
+        """
+        frames = torch.as_tensor(np.asarray(frames, dtype=np.uint8))
+        single = frames.ndim == 4
+        if single:
+            frames = frames[None]
+        if actions is None:
+            actions = self._no_actions.expand(len(frames), -1)
+        else:
+            actions = torch.as_tensor(np.asarray(actions, dtype=np.float32)).reshape(len(frames), -1)
+        with torch.inference_mode():
+            action = self.policy(frames, actions).numpy()
+        return action[0] if single else action
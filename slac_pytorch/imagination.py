@@ -0,0 +1,94 @@
+import torch
+
+
+class LatentImagination:
+    """
+    Rolls the latent model's prior forward from the posterior latents of replay sequences, without the
+    simulator. Actions come from the actor, which sees the decoded and re-encoded imagined frames, or from
+    any callable action_fn(z, t) returning a batch of actions for the latents z = [z1(t), z2(t)] of step t.
+    Trajectories are imagined in chunks of chunk_size sequences (0 means all at once).
+    """
+
+    def __init__(self, latent, actor, chunk_size=0):
+        self.latent = latent
+        self.actor = actor
+        self.chunk_size = int(chunk_size)
+
+    def start(self, state_, action_):
+        """
+        Posterior latents z1(t), z2(t) at the last step of the sequences, and the features and actions the
+        actor conditions on at that step.
+        """
+        feature_ = self.latent.encoder(state_)
+        _, _, z1_, z2_ = self.latent.sample_posterior(feature_, action_)
+        # Features x(2:t+1) and actions a(2:t) of the last step, as in create_feature_actions.
+        return z1_[:, -1], z2_[:, -1], feature_[:, 1:], action_[:, 1:]
+
+    def rollout(self, state_, action_, horizon, action_fn=None, deterministic=True, decode=False):
+        """
+        Imagine horizon steps from each sequence (state_, action_) of a latent model batch. Returns a dict with
+        the latents z (B, horizon + 1, Z), actions (B, horizon, |A|) and predicted rewards (B, horizon), and
+        the decoded uint8 frames (B, horizon + 1, C, H, W) if decode is set.
+        """
+        size = self.chunk_size if self.chunk_size > 0 else len(state_)
+        chunks = []
+        with torch.inference_mode():
+            for x, a in zip(state_.split(size), action_.split(size)):
+                chunks.append(self._rollout(x, a, horizon, action_fn, deterministic, decode))
+        return {key: torch.cat([chunk[key] for chunk in chunks]) for key in chunks[0]}
+
+    def _rollout(self, state_, action_, horizon, action_fn, deterministic, decode):
+        z1, z2, features, actions = self.start(state_, action_)
+        z_, action_out_, reward_, frames_ = [torch.cat([z1, z2], dim=1)], [], [], []
+        if decode:
+            frames_.append(self._decode(z_[0]))
+
+        for t in range(horizon):
+            if action_fn is not None:
+                action = action_fn(z_[-1], t)
+            else:
+                feature_action = torch.cat([features.flatten(1), actions.flatten(1)], dim=1)
+                action = self.actor(feature_action) if deterministic else self.actor.sample(feature_action)[0]
+            # p(z1(t+1) | z2(t), a(t)) and p(z2(t+1) | z1(t+1), z2(t), a(t))
+            z1_mean, z1_std = self.latent.z1_prior(torch.cat([z2, action], dim=1))
+            next_z1 = z1_mean + torch.randn_like(z1_std) * z1_std
+            z2_mean, z2_std = self.latent.z2_prior(torch.cat([next_z1, z2, action], dim=1))
+            next_z2 = z2_mean + torch.randn_like(z2_std) * z2_std
+            # p(r(t) | z1(t), z2(t), a(t), z1(t+1), z2(t+1))
+            reward_mean, _ = self.latent.reward(torch.cat([z1, z2, action, next_z1, next_z2], dim=1))
+
+            z1, z2 = next_z1, next_z2
+            z_.append(torch.cat([z1, z2], dim=1))
+            action_out_.append(action)
+            reward_.append(reward_mean[:, 0])
+            if decode or action_fn is None:
+                frame = self._decode(z_[-1])
+                if decode:
+                    frames_.append(frame)
+                if action_fn is None:
+                    # The actor sees the imagined frame as its newest observation.
+                    feature = self.latent.encoder(frame.unsqueeze(1).float().div_(255.0))
+                    features = torch.cat([features[:, 1:], feature], dim=1)
+                    actions = torch.cat([actions[:, 1:], action.unsqueeze(1)], dim=1)
+
+        out = dict(
+            z=torch.stack(z_, dim=1),
+            action=torch.stack(action_out_, dim=1),
+            reward=torch.stack(reward_, dim=1),
+        )
+        if decode:
+            out["frames"] = torch.stack(frames_, dim=1)
+        return out
+
+    def _decode(self, z):
+        state_mean, _ = self.latent.decoder(z.unsqueeze(1))
+        return state_mean[:, 0].clamp(0.0, 1.0).mul_(255.0).round_().to(torch.uint8)
+
+    def score(self, state_, action_, horizon, gamma=1.0, action_fn=None, deterministic=True):
+        """
+        Mean and standard deviation of the discounted imagined return over horizon steps.
+        """
+        reward_ = self.rollout(state_, action_, horizon, action_fn, deterministic)["reward"]
+        discount = gamma ** torch.arange(horizon, device=reward_.device, dtype=reward_.dtype)
+        returns = (reward_ * discount).sum(dim=1)
+        return returns.mean().item(), returns.std().item()
@@ -0,0 +1,224 @@
+import os
+import queue
+import socket
+import socketserver
+import threading
+from collections import deque
+from concurrent.futures import Future
+from time import perf_counter
+
+import numpy as np
+import torch
+
+from slac_pytorch.common.protocol import connect, decode_json, encode_json, recv_message, send_message
+from slac_pytorch.network import GaussianPolicy
+from slac_pytorch.network.latent import Encoder, ObsEncoder
+
+ACT, STATS, CLOSE, OK, ERROR = range(5)
+
+
+def load_policy(model_dir, args, device):
+    """
+    Load the encoder and actor saved by SlacAlgorithm.save_model. The encoder type, the number of input
+    channels and the action dimension are read from the saved weights.
+    """
+    encoder_state = torch.load(os.path.join(model_dir, "encoder.pth"), map_location=device)
+    actor_state = torch.load(os.path.join(model_dir, "actor.pth"), map_location=device)
+    if "net.0.weight" in encoder_state:
+        encoder = Encoder(encoder_state["net.0.weight"].shape[1], args.feature_dim)
+    else:
+        encoder = ObsEncoder(encoder_state["conv1.weight"].shape[1], args.feature_dim)
+    # The last layer of the actor outputs the means and log stds.
+    action_dim = [w for key, w in actor_state.items() if key.endswith("weight")][-1].shape[0] // 2
+    actor = GaussianPolicy((action_dim,), args.num_sequences, args.feature_dim, args.hidden_units)
+    encoder.load_state_dict(encoder_state)
+    actor.load_state_dict(actor_state)
+    return encoder.to(device).eval(), actor.to(device).eval()
+
+
+class DynamicBatcher:
+    """
+    Runs the deterministic policy for requests submitted from any number of threads. A worker thread takes
+    the waiting requests, up to max_batch_size frame stacks, and waits at most max_wait seconds after the
+    first one for more, then answers all of them with one encoder and actor forward pass.
+    """
+
+    def __init__(self, encoder, actor, device, max_batch_size=64, max_wait=0.002, latency_window=10000):
+        self.encoder = encoder
+        self.actor = actor
+        self.device = device
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max_wait
+        self._requests = queue.Queue()
+        self._pending = []
+        self._latencies = deque(maxlen=latency_window)
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_stacks = 0
+        self.start_time = perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, frames, actions):
+        """
+        Queue uint8 frame stacks of shape (B, S, C, H, W) with their flattened previous actions of shape
+        (B, (S - 1) * |A|). Returns a future of the actions.
+        """
+        future = Future()
+        self._requests.put((frames, actions, future, perf_counter()))
+        return future
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        # Block for the first request, then collect more until the batch is full or the deadline passes.
+        first = self._pending.pop() if self._pending else self._requests.get()
+        if first is None:
+            return None
+        batch, size = [first], len(first[0])
+        deadline = perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            try:
+                request = self._requests.get(timeout=max(0.0, deadline - perf_counter()))
+            except queue.Empty:
+                break
+            if request is None or size + len(request[0]) > self.max_batch_size:
+                # Left for the next batch, which stops the worker when closing.
+                self._pending.append(request)
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                frames = torch.from_numpy(np.concatenate([request[0] for request in batch])).to(self.device)
+                actions = torch.from_numpy(np.concatenate([request[1] for request in batch])).to(self.device)
+                with torch.inference_mode():
+                    state = frames.float().div_(255.0)
+                    feature = self.encoder(state).view(len(state), -1)
+                    action = self.actor(torch.cat([feature, actions], dim=1)).cpu().numpy()
+            except Exception as e:
+                for request in batch:
+                    request[2].set_exception(e)
+                continue
+            end, start = perf_counter(), 0
+            with self._lock:
+                for frames, _, future, submitted in batch:
+                    future.set_result(action[start : start + len(frames)])
+                    start += len(frames)
+                    self._latencies.append(end - submitted)
+                self.num_requests += len(batch)
+                self.num_batches += 1
+                self.num_stacks += len(action)
+
+    def stats(self):
+        """
+        Throughput and request latency (from submission to answer) of the batcher.
+        """
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000.0
+            elapsed = perf_counter() - self.start_time
+            p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) else (0.0, 0.0)
+            return dict(
+                requests=self.num_requests,
+                batches=self.num_batches,
+                mean_batch_size=self.num_stacks / max(1, self.num_batches),
+                stacks_per_second=self.num_stacks / elapsed,
+                latency_p50_ms=float(p50),
+                latency_p99_ms=float(p99),
+            )
+
+
+class _PolicyHandler(socketserver.BaseRequestHandler):
+    """
+    Serves one client, whose act requests are batched with those of all other clients.
+    """
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            try:
+                op, arrays = recv_message(self.request)
+            except ConnectionError:
+                return
+            if op == CLOSE:
+                send_message(self.request, OK)
+                return
+            try:
+                if op == ACT:
+                    reply = [self.server.batcher.submit(*arrays).result()]
+                else:
+                    reply = [encode_json(self.server.batcher.stats())]
+            except Exception as e:
+                send_message(self.request, ERROR, [encode_json(repr(e))])
+            else:
+                send_message(self.request, OK, reply)
+
+
+class PolicyServer(socketserver.ThreadingTCPServer):
+    """
+    Serves the deterministic policy of a save_model directory to any number of clients, batching their
+    requests dynamically.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, args, model_dir, device=torch.device("cpu")):
+        host, port = address.rsplit(":", 1)
+        super().__init__((host, int(port)), _PolicyHandler)
+        encoder, actor = load_policy(model_dir, args, device)
+        self.batcher = DynamicBatcher(
+            encoder, actor, device, args.inference_max_batch_size, args.inference_max_wait_ms / 1000.0
+        )
+
+    def server_close(self):
+        super().server_close()
+        self.batcher.close()
+
+
+class PolicyClient:
+    """
+    Connection to a PolicyServer.
+    """
+
+    def __init__(self, address):
+        self.sock = connect(address)
+
+    def _call(self, op, arrays=()):
+        send_message(self.sock, op, arrays)
+        status, reply = recv_message(self.sock)
+        if status == ERROR:
+            raise RuntimeError(f"Policy server error: {decode_json(reply[0])}")
+        return reply
+
+    def act(self, frames, actions):
+        """
+        Actions for a uint8 frame stack of shape (S, C, H, W) and its previous actions, or for a batch of them
+        with shape (B, S, C, H, W). A SlacObservation's state and action can be passed as they are.
+        """
+        frames = np.asarray(frames, dtype=np.uint8)
+        single = frames.ndim == 4
+        if single:
+            frames = frames[None]
+        actions = np.asarray(actions, dtype=np.float32).reshape(len(frames), -1)
+        (action,) = self._call(ACT, [frames, actions])
+        return action[0] if single else action
+
+    def stats(self):
+        (stats,) = self._call(STATS)
+        return decode_json(stats)
+
+    def close(self):
+        self._call(CLOSE)
+        self.sock.close()
@@ -0,0 +1,243 @@
+import os
+import sys
+import warnings
+
+import numpy as np
+import torch
+
+from slac_pytorch.buffer import LazyFrames
+from slac_pytorch.network import GaussianPolicy, LatentModel, ObsLatentModel, TwinnedQNetwork
+from slac_pytorch.utils import ActivationMemoryMeter
+
+MB = 2**20
+
+
+def tensor_bytes(tensor):
+    return tensor.element_size() * tensor.nelement()
+
+
+def _root(array):
+    # The array which owns the memory of a view.
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array
+
+
+def buffer_memory(buffer):
+    """
+    Bytes held by a replay buffer: the frames, counting shared frames once, the Python objects of the
+    LazyFrames and frame arrays, and the action, reward and done tensors (plus priorities if any). Walks all
+    stored sequences, so it takes a moment for large buffers. Buffers stored elsewhere report nothing.
+    """
+    if not hasattr(buffer, "state_"):
+        return {}
+    roots, views = {}, {}
+    overhead = sys.getsizeof(buffer.state_)
+    for item in buffer.state_:
+        if item is None:
+            continue
+        overhead += sys.getsizeof(item) + sys.getsizeof(item._frames)
+        for frame in item._frames:
+            views[id(frame)] = frame
+    for frame in views.values():
+        root = _root(frame)
+        roots[id(root)] = root
+        # Array objects without their data.
+        overhead += sys.getsizeof(frame) - (frame.nbytes if frame is root else 0)
+    report = dict(
+        frames=sum(root.nbytes for root in roots.values()),
+        lazy_frames_overhead=overhead,
+        actions=tensor_bytes(buffer.action_),
+        rewards=tensor_bytes(buffer.reward_),
+        dones=tensor_bytes(buffer.done_),
+    )
+    trees = [getattr(buffer, name) for name in ("tree_latent", "tree_sac") if hasattr(buffer, name)]
+    if trees:
+        report["priorities"] = sum(tree._tree.nbytes for tree in trees)
+    return report
+
+
+def module_memory(module, optimizer=None):
+    """
+    Bytes held by the parameters and gradients of a network and by its optimizer state, e.g. Adam's moments.
+    """
+    params = list(module.parameters())
+    report = dict(
+        parameters=sum(tensor_bytes(p) for p in params),
+        gradients=sum(tensor_bytes(p.grad) for p in params if p.grad is not None),
+    )
+    if optimizer is not None:
+        ids = {id(p) for p in params}
+        report["optimizer_state"] = sum(
+            tensor_bytes(value)
+            for p, state in optimizer.state.items()
+            if id(p) in ids
+            for value in state.values()
+            if torch.is_tensor(value)
+        )
+    return report
+
+
+def algo_memory(algo):
+    """
+    Memory report of a SlacAlgorithm: the replay buffer, every network with its optimizer, and the tensors
+    saved for the backward pass of the last measured latent and SAC updates. Keys are "component/kind".
+    """
+    report = {f"buffer/{key}": value for key, value in buffer_memory(algo.buffer).items()}
+    networks = (
+        ("latent", algo.latent, algo.optim_latent),
+        ("actor", algo.actor, algo.optim_actor),
+        ("critic", algo.critic, algo.optim_critic),
+        ("critic_target", algo.critic_target, None),
+    )
+    for name, module, optimizer in networks:
+        report.update({f"{name}/{key}": value for key, value in module_memory(module, optimizer).items()})
+    report.update({f"saved_tensors/{name}": value for name, value in algo.saved_tensor_bytes.items()})
+    return report
+
+
+def predict_memory(args, state_shape, action_shape, episode_steps, obs=False, num_envs=1):
+    """
+    Predict the memory report of a configuration before allocating the replay buffer. The buffer is assumed
+    to be full of episodes of episode_steps steps, whose consecutive sequences share all but one frame. The
+    networks are built on the CPU to count their parameters, and the tensors saved for the backward pass of
+    the latent update are extrapolated to batch_size_latent from batches of 1 and 2 sequences. Besides the
+    activations, these include the weight copies saved for matrix products.
+    """
+    num_sequences = int(args.num_sequences)
+    if args.shard_replay:
+        buffer_size = sum(args.shard_buffer_sizes or [int(args.buffer_size) // num_envs] * num_envs)
+    else:
+        buffer_size = int(args.buffer_size)
+    # Each episode stores episode_steps + 1 frames in episode_steps - num_sequences + 1 sequences.
+    frames_per_sequence = (episode_steps + 1) / max(1, episode_steps - num_sequences + 1)
+    num_frames = int(np.ceil(buffer_size * frames_per_sequence))
+    frame = np.zeros(state_shape, dtype=np.uint8)
+    lazy_frames = LazyFrames([frame] * (num_sequences + 1))
+    sequence_overhead = sys.getsizeof(lazy_frames) + sys.getsizeof(lazy_frames._frames) + 8
+
+    frame_overhead = sys.getsizeof(frame) - frame.nbytes
+    tensor = num_sequences * 4
+    report = {
+        "buffer/frames": num_frames * frame.nbytes,
+        "buffer/lazy_frames_overhead": buffer_size * sequence_overhead + num_frames * frame_overhead,
+        "buffer/actions": buffer_size * tensor * action_shape[0],
+        "buffer/rewards": buffer_size * tensor,
+        "buffer/dones": buffer_size * tensor,
+    }
+    if args.prioritized_replay:
+        report["buffer/priorities"] = 2 * 2 * (1 << max(1, (buffer_size - 1).bit_length())) * 8
+
+    latent_cls = ObsLatentModel if obs else LatentModel
+    latent = latent_cls(
+        state_shape,
+        action_shape,
+        args.feature_dim,
+        args.z1_dim,
+        args.z2_dim,
+        args.hidden_units,
+        decode_steps=args.decode_steps,
+        decode_mode=args.decode_mode,
+    )
+    actor = GaussianPolicy(action_shape, num_sequences, args.feature_dim, args.hidden_units)
+    critic = TwinnedQNetwork(action_shape, args.z1_dim, args.z2_dim, args.hidden_units)
+    for name, module in (("latent", latent), ("actor", actor), ("critic", critic)):
+        size = sum(tensor_bytes(p) for p in module.parameters())
+        # Adam keeps two moments per parameter.
+        report.update({f"{name}/parameters": size, f"{name}/gradients": size, f"{name}/optimizer_state": 2 * size})
+    report["critic_target/parameters"] = report["critic/parameters"]
+
+    # Saved tensors grow linearly with the batch size, apart from the fixed weight copies, so measure two batch
+    # sizes and extrapolate.
+    saved_bytes = [_latent_saved_bytes(latent, args, state_shape, action_shape, size) for size in (1, 2)]
+    report["saved_tensors/latent"] = saved_bytes[0] + (saved_bytes[1] - saved_bytes[0]) * (args.batch_size_latent - 1)
+    return report
+
+
+def _latent_saved_bytes(latent, args, state_shape, action_shape, batch_size):
+    num_sequences = int(args.num_sequences)
+    state_ = torch.rand(batch_size, num_sequences + 1, *state_shape)
+    action_ = torch.rand(batch_size, num_sequences, *action_shape)
+    reward_ = torch.zeros(batch_size, num_sequences, 1)
+    with ActivationMemoryMeter("cpu") as meter:
+        if args.checkpoint_latent or args.latent_chunk_size > 0 or args.posterior_block_size > 0:
+            latent.calculate_loss_checkpointed(
+                state_,
+                action_,
+                reward_,
+                reward_,
+                chunk_size=args.latent_chunk_size,
+                block_size=args.posterior_block_size,
+                checkpoint=args.checkpoint_latent,
+            )
+        else:
+            latent.calculate_loss(state_, action_, reward_, reward_)
+    return meter.saved_bytes
+
+
+def host_bytes(report, device):
+    """
+    Part of a memory report held in host memory, where everything but the frames lives on the device.
+    """
+    if torch.device(device).type == "cpu":
+        return sum(report.values())
+    return sum(value for key, value in report.items() if key in ("buffer/frames", "buffer/lazy_frames_overhead"))
+
+
+def available_host_memory():
+    """
+    Bytes of host memory available without swapping, or None if unknown.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Free pages, which ignores reclaimable caches.
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def warn_if_swapping(required_bytes, fraction=0.9):
+    """
+    Warn if required_bytes more bytes would exceed the given fraction of the available host memory.
+    Returns whether it warned.
+    """
+    available = available_host_memory()
+    if available is None or required_bytes <= fraction * available:
+        return False
+    warnings.warn(
+        f"Needs {required_bytes / MB:.0f} MB more host memory, but only {available / MB:.0f} MB are available. "
+        "The host will likely swap; consider a smaller buffer_size or num_sequences.",
+        ResourceWarning,
+    )
+    return True
+
+
+def format_report(report):
+    lines = [f"{key:40s} {value / MB:12.1f} MB" for key, value in report.items()]
+    lines.append(f"{'total':40s} {sum(report.values()) / MB:12.1f} MB")
+    return "\n".join(lines)
+
+
+def check_config(args, env, device, obs=False, num_envs=1, universe=None):
+    """
+    Predict the memory report of a configuration for the environment's observations, and warn if its host
+    memory part would not fit. Returns the report.
+    """
+    max_episode_steps = getattr(getattr(env, "spec", None), "max_episode_steps", None) or 1000
+    if (universe or args.universe) == 'gym':
+        # The time limit of a gym env counts physics steps, while the buffer stores one step per action.
+        # dmc2gym already divides its limit by the frame skip.
+        episode_steps = max(1, max_episode_steps // args.action_repeat)
+    else:
+        episode_steps = max_episode_steps
+    report = predict_memory(
+        args, env.observation_space.shape, env.action_space.shape, episode_steps, obs=obs, num_envs=num_envs
+    )
+    warn_if_swapping(host_bytes(report, device), args.memory_swap_fraction)
+    return report
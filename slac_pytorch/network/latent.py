@@ -6,7 +6,7 @@ import torch.nn as nn
 from torch.nn import functional as F
 
 from slac_pytorch.network.initializer import initialize_weight
-from slac_pytorch.utils import build_mlp, calculate_kl_divergence
+from slac_pytorch.utils import build_mlp, calculate_kl_divergence, run_checkpointed, run_chunked
 
 
 class FixedGaussian(torch.jit.ScriptModule):
@@ -220,8 +220,14 @@ class LatentModel(torch.jit.ScriptModule):
         z1_dim=32,
         z2_dim=256,
         hidden_units=(256, 256),
+        decode_steps=0,
+        decode_mode="random",
     ):
         super(LatentModel, self).__init__()
+        assert decode_mode in ("random", "strided"), f"Unknown decode mode: {decode_mode}"
+        # Number of timesteps per sequence to reconstruct (0 means all of them).
+        self.decode_steps = int(decode_steps)
+        self.decode_mode = decode_mode
         # p(z1(0)) = N(0, I)
         self.z1_prior_init = FixedGaussian(z1_dim, 1.0)
         # p(z2(0) | z1(0))
@@ -281,25 +287,32 @@ class LatentModel(torch.jit.ScriptModule):
         return (z1_mean_, z1_std_)
 
     @torch.jit.script_method
-    def sample_posterior(self, features_, actions_):
+    def sample_posterior_init(self, feature):
         # p(z1(0)) = N(0, I)
-        z1_mean, z1_std = self.z1_posterior_init(features_[:, 0])
+        z1_mean, z1_std = self.z1_posterior_init(feature)
         z1 = z1_mean + torch.randn_like(z1_std) * z1_std
         # p(z2(0) | z1(0))
         z2_mean, z2_std = self.z2_posterior_init(z1)
         z2 = z2_mean + torch.randn_like(z2_std) * z2_std
+        return (z1_mean, z1_std, z1, z2)
 
-        z1_mean_ = [z1_mean]
-        z1_std_ = [z1_std]
-        z1_ = [z1]
-        z2_ = [z2]
-
-        for t in range(1, actions_.size(1) + 1):
+    @torch.jit.script_method
+    def sample_posterior_block(self, features_, actions_, z2):
+        """
+        Roll the posterior over a block of timesteps, where features_[:, i] is paired with actions_[:, i] and
+        z2 is the last latent before the block.
+        """
+        z1_mean_ = []
+        z1_std_ = []
+        z1_ = []
+        z2_ = []
+
+        for t in range(actions_.size(1)):
             # q(z1(t) | feat(t), z2(t-1), a(t-1))
-            z1_mean, z1_std = self.z1_posterior(torch.cat([features_[:, t], z2, actions_[:, t - 1]], dim=1))
+            z1_mean, z1_std = self.z1_posterior(torch.cat([features_[:, t], z2, actions_[:, t]], dim=1))
             z1 = z1_mean + torch.randn_like(z1_std) * z1_std
             # q(z2(t) | z1(t), z2(t-1), a(t-1))
-            z2_mean, z2_std = self.z2_posterior(torch.cat([z1, z2, actions_[:, t - 1]], dim=1))
+            z2_mean, z2_std = self.z2_posterior(torch.cat([z1, z2, actions_[:, t]], dim=1))
             z2 = z2_mean + torch.randn_like(z2_std) * z2_std
 
             z1_mean_.append(z1_mean)
@@ -314,25 +327,52 @@ class LatentModel(torch.jit.ScriptModule):
         return (z1_mean_, z1_std_, z1_, z2_)
 
     @torch.jit.script_method
-    def calculate_loss(self, state_, action_, reward_, done_):
-        # Calculate the sequence of features.
-        # print(f'state: {state_.shape} action: {action_.shape} reward: {reward_.shape} done: {done_.shape}')
-        feature_ = self.encoder(state_)
-        # Sample from latent variable model.
-        z1_mean_post_, z1_std_post_, z1_, z2_ = self.sample_posterior(feature_, action_)
-        z1_mean_pri_, z1_std_pri_ = self.sample_prior(action_, z2_)
+    def sample_posterior(self, features_, actions_):
+        z1_mean, z1_std, z1, z2 = self.sample_posterior_init(features_[:, 0])
+        z1_mean_, z1_std_, z1_, z2_ = self.sample_posterior_block(features_[:, 1:], actions_, z2)
 
-        # Calculate KL divergence loss.
-        loss_kld = calculate_kl_divergence(z1_mean_post_, z1_std_post_, z1_mean_pri_, z1_std_pri_).mean(dim=0).sum()
+        z1_mean_ = torch.cat([z1_mean.unsqueeze(1), z1_mean_], dim=1)
+        z1_std_ = torch.cat([z1_std.unsqueeze(1), z1_std_], dim=1)
+        z1_ = torch.cat([z1.unsqueeze(1), z1_], dim=1)
+        z2_ = torch.cat([z2.unsqueeze(1), z2_], dim=1)
+        return (z1_mean_, z1_std_, z1_, z2_)
 
-        # Prediction loss of images.
-        z_ = torch.cat([z1_, z2_], dim=-1)
+    @torch.jit.script_method
+    def subsample_timesteps(self, z_, state_):
+        """
+        Select the timesteps to reconstruct. Returns the selected latents and images together with the factor
+        that keeps the summed image loss unbiased.
+        """
+        B, S, Z = z_.size()
+        k = self.decode_steps
+        if k <= 0 or k >= S:
+            return z_, state_, 1.0
+
+        if self.decode_mode == "strided":
+            # k evenly spread timesteps with a random offset per sequence, so every timestep is hit with
+            # probability k/S even when S is not a multiple of k.
+            offset = torch.randint(0, S, (B, 1), device=z_.device)
+            steps = torch.div(torch.arange(k, device=z_.device) * S, k, rounding_mode="floor")
+            idx = (offset + steps.unsqueeze(0)) % S
+        else:
+            # k distinct timesteps drawn uniformly per sequence.
+            idx = torch.rand(B, S, device=z_.device).argsort(dim=1)[:, :k]
+
+        batch_idx = torch.arange(B, device=z_.device).unsqueeze(1)
+        return z_[batch_idx, idx], state_[batch_idx, idx], float(S) / float(k)
+
+    @torch.jit.script_method
+    def calculate_image_loss(self, z_, state_):
+        """
+        Negative log-likelihood of the images given their latents, summed per sequence.
+        """
         state_mean_, state_std_ = self.decoder(z_)
         state_noise_ = (state_ - state_mean_) / (state_std_ + 1e-8)
         log_likelihood_ = (-0.5 * state_noise_.pow(2) - state_std_.log()) - 0.5 * math.log(2 * math.pi)
-        loss_image = -log_likelihood_.mean(dim=0).sum()
+        return -log_likelihood_.flatten(1).sum(dim=1)
 
-        # Prediction loss of rewards.
+    @torch.jit.script_method
+    def calculate_reward_loss(self, z_, action_, reward_, done_):
         x = torch.cat([z_[:, :-1], action_, z_[:, 1:]], dim=-1)
         B, S, X = x.shape
         reward_mean_, reward_std_ = self.reward(x.view(B * S, X))
@@ -340,9 +380,109 @@ class LatentModel(torch.jit.ScriptModule):
         reward_std_ = reward_std_.view(B, S, 1)
         reward_noise_ = (reward_ - reward_mean_) / (reward_std_ + 1e-8)
         log_likelihood_reward_ = (-0.5 * reward_noise_.pow(2) - reward_std_.log()) - 0.5 * math.log(2 * math.pi)
-        loss_reward = -log_likelihood_reward_.mul_(1 - done_).mean(dim=0).sum()
+        return -log_likelihood_reward_.mul_(1 - done_).flatten(1).sum(dim=1)
+
+    @torch.jit.script_method
+    def calculate_loss(self, state_, action_, reward_, done_):
+        """
+        KL divergence, image and reward losses of each sequence in the batch.
+        """
+        # Calculate the sequence of features.
+        feature_ = self.encoder(state_)
+        # Sample from latent variable model.
+        z1_mean_post_, z1_std_post_, z1_, z2_ = self.sample_posterior(feature_, action_)
+        z1_mean_pri_, z1_std_pri_ = self.sample_prior(action_, z2_)
+
+        # Calculate KL divergence loss.
+        loss_kld = calculate_kl_divergence(z1_mean_post_, z1_std_post_, z1_mean_pri_, z1_std_pri_).flatten(1).sum(dim=1)
+
+        # Prediction loss of images.
+        z_ = torch.cat([z1_, z2_], dim=-1)
+        z_dec_, state_dec_, scale = self.subsample_timesteps(z_, state_)
+        loss_image = self.calculate_image_loss(z_dec_, state_dec_) * scale
+
+        # Prediction loss of rewards.
+        loss_reward = self.calculate_reward_loss(z_, action_, reward_, done_)
+        return loss_kld, loss_image, loss_reward
+
+    def reconstruction_error(self, loss_image_, state_):
+        """
+        Image losses of sequences of state_ minus their minimum, the loss of a perfect reconstruction under the
+        decoder's fixed std. Unlike the negative log-likelihood itself, this is nonnegative and grows with the
+        squared reconstruction error.
+        """
+        min_loss = state_[0].numel() * (math.log(self.decoder.std) + 0.5 * math.log(2 * math.pi))
+        return (loss_image_ - min_loss).clamp(min=0.0)
+
+    def calculate_loss_checkpointed(self, state_, action_, reward_, done_, chunk_size=0, block_size=0, checkpoint=True):
+        """
+        Same losses as calculate_loss, computed with bounded activation memory. The encoder and the decoder run
+        over micro-batches of chunk_size flattened frames and the posterior over blocks of block_size timesteps
+        (0 disables either). With checkpoint=True, each chunk and block only keeps its inputs and is recomputed
+        during the backward pass.
+        """
+        B = state_.size(0)
+
+        # Calculate the sequence of features.
+        frames = state_.flatten(0, 1)
+        feature_ = torch.cat(
+            run_chunked(lambda x: self.encoder(x.unsqueeze(1)).squeeze(1), (frames,), chunk_size, checkpoint), dim=0
+        ).view(B, state_.size(1), -1)
+
+        # Sample from latent variable model.
+        z1_mean_post_, z1_std_post_, z1_, z2_ = self.sample_posterior_blocked(feature_, action_, block_size, checkpoint)
+        z1_mean_pri_, z1_std_pri_ = self.sample_prior(action_, z2_)
+
+        # Calculate KL divergence loss.
+        loss_kld = calculate_kl_divergence(z1_mean_post_, z1_std_post_, z1_mean_pri_, z1_std_pri_).flatten(1).sum(dim=1)
+
+        # Prediction loss of images.
+        z_ = torch.cat([z1_, z2_], dim=-1)
+        z_dec_, state_dec_, scale = self.subsample_timesteps(z_, state_)
+        losses = run_chunked(
+            lambda z, x: self.calculate_image_loss(z.unsqueeze(1), x.unsqueeze(1)),
+            (z_dec_.flatten(0, 1), state_dec_.flatten(0, 1)),
+            chunk_size,
+            checkpoint,
+        )
+        loss_image = torch.cat(losses).view(B, -1).sum(dim=1) * scale
+
+        # Prediction loss of rewards.
+        loss_reward = self.calculate_reward_loss(z_, action_, reward_, done_)
         return loss_kld, loss_image, loss_reward
 
+    def sample_posterior_blocked(self, features_, actions_, block_size, checkpoint=True):
+        """
+        sample_posterior split into blocks of block_size timesteps which are checkpointed separately.
+        """
+        if block_size <= 0:
+            return self.sample_posterior(features_, actions_)
+
+        z1_mean, z1_std, z1, z2 = self.sample_posterior_init(features_[:, 0])
+        z1_mean_ = [z1_mean.unsqueeze(1)]
+        z1_std_ = [z1_std.unsqueeze(1)]
+        z1_ = [z1.unsqueeze(1)]
+        z2_ = [z2.unsqueeze(1)]
+
+        for t in range(1, actions_.size(1) + 1, block_size):
+            inputs = (features_[:, t : t + block_size], actions_[:, t - 1 : t - 1 + block_size], z2)
+            if checkpoint and torch.is_grad_enabled():
+                block = run_checkpointed(self.sample_posterior_block, *inputs)
+            else:
+                block = self.sample_posterior_block(*inputs)
+            z1_mean_.append(block[0])
+            z1_std_.append(block[1])
+            z1_.append(block[2])
+            z2_.append(block[3])
+            z2 = block[3][:, -1]
+
+        return (
+            torch.cat(z1_mean_, dim=1),
+            torch.cat(z1_std_, dim=1),
+            torch.cat(z1_, dim=1),
+            torch.cat(z2_, dim=1),
+        )
+
 
 class ObsLatentModel(LatentModel):
     """
@@ -357,13 +497,17 @@ class ObsLatentModel(LatentModel):
         z1_dim=32,
         z2_dim=256,
         hidden_units=(256, 256),
+        decode_steps=0,
+        decode_mode="random",
     ):
         super().__init__(state_shape,
                          action_shape,
                          feature_dim,
                          z1_dim, 
                          z2_dim,
-                         hidden_units)
+                         hidden_units,
+                         decode_steps,
+                         decode_mode)
        
 
         # feat(t) = Encoder(x(t))
@@ -0,0 +1,315 @@
+import socket
+import socketserver
+import threading
+
+import numpy as np
+import torch
+
+from slac_pytorch.buffer import SequenceBuffer, make_replay_buffer
+from slac_pytorch.common.protocol import connect, decode_json, encode_json, recv_message, send_message
+from slac_pytorch.utils import prefetch_iterator
+
+CONFIGURE, INSERT, SAMPLE_LATENT, SAMPLE_SAC, SIZE, CLOSE, OK, ERROR = range(8)
+# Kinds of the records streamed by collectors.
+RESET_EPISODE, STEP = range(2)
+
+
+class RateLimiter:
+    """
+    Keeps the number of sampled sequences per inserted sequence close to samples_per_insert by blocking
+    inserts when learners fall behind and samples when collectors fall behind, within error_buffer sampled
+    sequences. Sampling waits until min_size sequences are stored. A ratio of 0 disables the limits.
+
+    error_buffer has to be larger than the sampled batches, otherwise sampling can block forever.
+    """
+
+    def __init__(self, samples_per_insert=0.0, min_size=1, error_buffer=1000.0):
+        self.samples_per_insert = float(samples_per_insert)
+        self.min_size = int(min_size)
+        self.error_buffer = float(error_buffer)
+        self.inserts = 0
+        self.samples = 0
+        self._cond = threading.Condition()
+
+    def _diff(self):
+        return self.inserts * self.samples_per_insert - self.samples
+
+    def _can_insert(self):
+        if self.samples_per_insert == 0 or self.inserts < self.min_size:
+            return True
+        return self._diff() + self.samples_per_insert <= self.min_size * self.samples_per_insert + self.error_buffer
+
+    def _can_sample(self, size, num_samples):
+        if size < self.min_size:
+            return False
+        if self.samples_per_insert == 0:
+            return True
+        return self._diff() - num_samples >= self.min_size * self.samples_per_insert - self.error_buffer
+
+    def await_insert(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(self._can_insert, timeout):
+                raise TimeoutError("Inserting timed out, the learners sample too slowly.")
+
+    def inserted(self, num_inserts):
+        with self._cond:
+            self.inserts += num_inserts
+            self._cond.notify_all()
+
+    def await_sample(self, size_fn, num_samples, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._can_sample(size_fn(), num_samples), timeout):
+                raise TimeoutError("Sampling timed out, the collectors insert too slowly.")
+            self.samples += num_samples
+            self._cond.notify_all()
+
+
+class _ReplayHandler(socketserver.BaseRequestHandler):
+    """
+    Serves one collector or learner. Collectors stream episode records which are assembled into sequences
+    per connection, so that consecutive sequences share their frames just like in a local ReplayBuffer.
+    """
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buff = None
+
+    def handle(self):
+        ops = {CONFIGURE: self.configure, INSERT: self.insert, SAMPLE_LATENT: self.sample_latent}
+        ops.update({SAMPLE_SAC: self.sample_sac, SIZE: self.size})
+        while True:
+            try:
+                op, arrays = recv_message(self.request)
+            except ConnectionError:
+                return
+            if op == CLOSE:
+                send_message(self.request, OK)
+                return
+            try:
+                reply = ops[op](*arrays)
+            except Exception as e:
+                send_message(self.request, ERROR, [encode_json(repr(e))])
+            else:
+                send_message(self.request, OK, reply)
+
+    def configure(self, request):
+        request = decode_json(request)
+        self.server.configure(request["state_shape"], request["action_shape"], request["num_shards"])
+        self.buff = SequenceBuffer(num_sequences=self.server.args.num_sequences)
+        return []
+
+    def insert(self, kinds, shards, states, actions, rewards, dones, episode_dones):
+        server = self.server
+        server.limiter.await_insert(server.timeout)
+        num_inserts = 0
+        for i, kind in enumerate(kinds):
+            if kind == RESET_EPISODE:
+                self.buff.reset_episode(states[i])
+                continue
+            self.buff.append(actions[i], rewards[i].item(), dones[i].item(), states[i])
+            if self.buff.is_full():
+                with server.lock:
+                    if server.sharded:
+                        server.buffer.set_shard(int(shards[i]))
+                    server.buffer.add_sequence(*self.buff.get())
+                num_inserts += 1
+            if episode_dones[i]:
+                self.buff.reset()
+        server.limiter.inserted(num_inserts)
+        return []
+
+    def _sample(self, batch_size, weights):
+        server = self.server
+        batch_size = int(batch_size)
+        server.limiter.await_sample(lambda: len(server.buffer), batch_size, server.timeout)
+        with server.lock:
+            idxes = server.buffer._sample_idxes(batch_size, weights if weights.size > 0 else None)
+            frames = server.buffer.get_frames(idxes)
+            return frames, server.buffer.action_[idxes], server.buffer.reward_[idxes], server.buffer.done_[idxes]
+
+    def sample_latent(self, batch_size, weights):
+        frames, action_, reward_, done_ = self._sample(batch_size, weights)
+        return [frames, action_.numpy(), reward_.numpy(), done_.numpy()]
+
+    def sample_sac(self, batch_size, weights):
+        frames, action_, reward_, done_ = self._sample(batch_size, weights)
+        return [frames, action_.numpy(), reward_[:, -1].numpy(), done_[:, -1].numpy()]
+
+    def size(self):
+        with self.server.lock:
+            return [np.array(len(self.server.buffer), dtype=np.int64)]
+
+
+class ReplayServer(socketserver.ThreadingTCPServer):
+    """
+    Replay service which owns the replay buffer on behalf of any number of collectors and learners. The
+    buffer is built by the first client from the configured buffer type and its observation shapes.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, args):
+        host, port = address.rsplit(":", 1)
+        super().__init__((host, int(port)), _ReplayHandler)
+        self.args = args
+        self.sharded = args.shard_replay
+        # Seconds a rate-limited insert or sample waits before failing (0 waits forever), so that a sampler
+        # ahead of the inserts errors out instead of hanging when no collector is left.
+        self.timeout = args.replay_timeout or None
+        self.limiter = RateLimiter(args.replay_samples_per_insert, args.replay_min_size, args.replay_error_buffer)
+        self.buffer = None
+        self.lock = threading.Lock()
+        self._shapes = None
+
+    def configure(self, state_shape, action_shape, num_shards):
+        assert not self.args.prioritized_replay, "The replay service does not support prioritized replay."
+        shapes = (tuple(state_shape), tuple(action_shape), num_shards)
+        with self.lock:
+            if self.buffer is None:
+                self.buffer = make_replay_buffer(self.args, shapes[0], shapes[1], torch.device("cpu"), num_shards)
+                self._shapes = shapes
+            assert shapes == self._shapes, f"Client shapes {shapes} do not match the buffer's {self._shapes}."
+
+
+class ReplayClient:
+    """
+    Replay buffer stored by a ReplayServer. It has the interface of ReplayBuffer for collecting (trajectories
+    are sent in batches of flush_steps records) and for sampling (batches are moved to the given device).
+    It may be used from several threads, e.g. by a prefetch_iterator while the main thread collects. Each
+    sampling thread has its own connection, so that a sample waiting on the rate limiter does not hold back
+    the inserts it is waiting for.
+    """
+
+    def __init__(self, address, num_sequences, state_shape, action_shape, device, num_shards=1, flush_steps=50):
+        self.num_sequences = int(num_sequences)
+        self.state_shape = tuple(state_shape)
+        self.action_shape = tuple(action_shape)
+        self.device = device
+        self.flush_steps = max(1, int(flush_steps))
+        self.shard = 0
+        self._records = []
+        # Guards the inserting connection and the queued records, which have to be sent in order.
+        self._lock = threading.RLock()
+        self.address = address
+        self.sock = connect(address)
+        self._local = threading.local()
+        self._sampling_socks = []
+        self._call(
+            CONFIGURE,
+            [encode_json(dict(state_shape=self.state_shape, action_shape=self.action_shape, num_shards=num_shards))],
+        )
+
+    @staticmethod
+    def _request(sock, op, arrays=()):
+        send_message(sock, op, arrays)
+        status, reply = recv_message(sock)
+        if status == ERROR:
+            raise RuntimeError(f"Replay server error: {decode_json(reply[0])}")
+        return reply
+
+    def _call(self, op, arrays=()):
+        with self._lock:
+            return self._request(self.sock, op, arrays)
+
+    def _sampling_call(self, op, arrays=()):
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = self._local.sock = connect(self.address)
+            with self._lock:
+                self._sampling_socks.append(sock)
+        return self._request(sock, op, arrays)
+
+    def set_shard(self, shard):
+        """
+        Route the trajectories of the following episodes to the given shard.
+        """
+        self.shard = shard
+
+    def reset_episode(self, state):
+        """
+        Set the initial observation. This has to be done before every episode starts.
+        """
+        with self._lock:
+            self._records.append((RESET_EPISODE, self.shard, state, None, 0.0, False, False))
+
+    def append(self, action, reward, done, next_state, episode_done):
+        """
+        Queue one transition, sending the queued records once there are flush_steps of them.
+        """
+        with self._lock:
+            self._records.append((STEP, self.shard, next_state, action, reward, done, episode_done))
+            if len(self._records) >= self.flush_steps:
+                self.flush()
+
+    def flush(self):
+        """
+        Send the queued records, blocking while the replay service holds back inserts.
+        """
+        with self._lock:
+            records, self._records = self._records, []
+            if records:
+                self._send(records)
+
+    def _send(self, records):
+        kinds, shards, states, actions, rewards, dones, episode_dones = zip(*records)
+        zero_action = np.zeros(self.action_shape, dtype=np.float32)
+        arrays = [
+            np.array(kinds, dtype=np.uint8),
+            np.array(shards, dtype=np.int32),
+            np.stack(states).astype(np.uint8, copy=False),
+            np.stack([zero_action if a is None else a for a in actions]).astype(np.float32, copy=False),
+            np.array(rewards, dtype=np.float32),
+            np.array(dones, dtype=bool),
+            np.array(episode_dones, dtype=bool),
+        ]
+        self._call(INSERT, arrays)
+
+    def _sample(self, op, batch_size, weights):
+        # Send our own pending trajectories first, as the rate limiter may be waiting for them. If another
+        # thread is sending, it may be held back until this sample, so do not wait for it.
+        if self._lock.acquire(blocking=False):
+            try:
+                self.flush()
+            finally:
+                self._lock.release()
+        weights = np.zeros(0) if weights is None else np.asarray(weights, dtype=np.float64)
+        frames, action_, reward_, done_ = self._sampling_call(op, [np.array(batch_size, dtype=np.int64), weights])
+        state_ = torch.tensor(frames, dtype=torch.uint8, device=self.device).float().div_(255.0)
+        return (state_, *(torch.as_tensor(x, device=self.device) for x in (action_, reward_, done_)))
+
+    def sample_latent(self, batch_size, weights=None):
+        """
+        Sample trajectories for updating latent variable model.
+        """
+        return self._sample(SAMPLE_LATENT, batch_size, weights)
+
+    def sample_sac(self, batch_size, weights=None):
+        """
+        Sample trajectories for updating SAC.
+        """
+        return self._sample(SAMPLE_SAC, batch_size, weights)
+
+    def iterate_latent(self, batch_size, num_batches=None, block_size=0, shuffle_blocks=8, prefetch=0):
+        """
+        Yield batches like sample_latent, by default as many as one epoch over the stored trajectories. The
+        service samples with replacement, so this is not an exact pass over the data and the block arguments
+        are ignored. With prefetch > 0, up to that many batches are requested ahead in a background thread.
+        """
+        if num_batches is None:
+            num_batches = len(self) // batch_size
+        batches = (self.sample_latent(batch_size) for _ in range(num_batches))
+        return prefetch_iterator(batches, prefetch) if prefetch > 0 else batches
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            for sock in [*self._sampling_socks, self.sock]:
+                self._request(sock, CLOSE)
+                sock.close()
+            self._sampling_socks = []
+
+    def __len__(self):
+        self.flush()
+        (size,) = self._call(SIZE)
+        return int(size)
@@ -8,6 +8,11 @@ import pandas as pd
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
+from slac_pytorch.dataset import export_buffer, iterate_latent_batches, load_dataset
+from slac_pytorch.environments.wrappers import VideoRecorder
+from slac_pytorch.imagination import LatentImagination
+from slac_pytorch.memory import MB, algo_memory, warn_if_swapping
+
 
 class SlacObservation:
     """
@@ -18,13 +23,13 @@ class SlacObservation:
         self.state_shape = state_shape
         self.action_shape = action_shape
         self.num_sequences = num_sequences
+        # Padding of the first steps of an episode, shared between episodes as it is never written to.
+        self._zero_state = np.zeros(self.state_shape, dtype=np.uint8)
+        self._zero_action = np.zeros(self.action_shape, dtype=np.float32)
 
     def reset_episode(self, state):
-        self._state = deque(maxlen=self.num_sequences)
-        self._action = deque(maxlen=self.num_sequences - 1)
-        for _ in range(self.num_sequences - 1):
-            self._state.append(np.zeros(self.state_shape, dtype=np.uint8))
-            self._action.append(np.zeros(self.action_shape, dtype=np.float32))
+        self._state = deque([self._zero_state] * (self.num_sequences - 1), maxlen=self.num_sequences)
+        self._action = deque([self._zero_action] * (self.num_sequences - 1), maxlen=self.num_sequences - 1)
         self._state.append(state)
 
     def append(self, state, action):
@@ -34,6 +39,13 @@ class SlacObservation:
         self._action.append(action)
         # print("Current state: \n ", self._state)
 
+    def write(self, state_out, action_out):
+        """
+        Write the frame history to state_out and the flattened action history to action_out.
+        """
+        np.stack(self._state, out=state_out)
+        np.concatenate(self._action, out=action_out)
+
     @property
     def state(self):
         # print('CALLED STATE: \n', self._state)
@@ -44,6 +56,66 @@ class SlacObservation:
         return np.array(self._action).reshape(1, -1)
 
 
+class UpdateSchedule:
+    """
+    Turns a (possibly fractional) number of updates per environment step into an integer number of updates
+    for each step, e.g. a ratio of 0.25 updates once every 4 steps and a ratio of 4 updates 4 times per step.
+    """
+
+    def __init__(self, ratio):
+        assert ratio >= 0, "Update ratio must be non-negative."
+        self.ratio = float(ratio)
+        self._credit = 0.0
+
+    def __call__(self):
+        self._credit += self.ratio
+        # Tolerate rounding errors of accumulated fractional ratios like 0.1.
+        num_updates = int(self._credit + 1e-6)
+        self._credit -= num_updates
+        return num_updates
+
+
+class ReturnInterval:
+    """
+    Student-t confidence interval of the mean return of the evaluation episodes run so far.
+    """
+
+    def __init__(self, confidence=0.95):
+        self.confidence = confidence
+        self.returns = []
+
+    def add(self, episode_return):
+        self.returns.append(float(episode_return))
+
+    @property
+    def count(self):
+        return len(self.returns)
+
+    @property
+    def mean(self):
+        return float(np.mean(self.returns))
+
+    @property
+    def half_width(self):
+        # Undefined for a single episode.
+        if self.count < 2:
+            return float("nan")
+        # Only needed for adaptive evaluation and its logs, so the trainer imports without scipy.
+        from scipy import stats
+
+        sem = np.std(self.returns, ddof=1) / np.sqrt(self.count)
+        return float(stats.t.ppf(0.5 + self.confidence / 2, self.count - 1) * sem)
+
+
+class NullWriter:
+    """
+    Writer that drops all summaries. Used by data-parallel learners other than rank 0.
+    """
+
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+
 class Trainer:
     """
     Trainer for SLAC.
@@ -57,6 +129,7 @@ class Trainer:
         algo,
         log_dir,
         current_steps=1,
+        random_cache=None,
         args=None,
     ):
         assert args is not None
@@ -69,6 +142,15 @@ class Trainer:
         # Env for evaluation.
         self.env_test = env_test
         self.env_test.reset(seed=2 ** 31 - args.seed)
+        # Record some of the evaluation episodes of image observations.
+        if args.video_dir and algo.rank == 0 and len(env_test.observation_space.shape) == 3:
+            self.env_test = VideoRecorder(
+                env_test,
+                args.video_dir,
+                args.video_every_n_episodes,
+                source="observation",
+                video_format=args.video_format,
+            )
 
         # Observations for training and evaluation.
         self.ob = SlacObservation(env.observation_space.shape, env.action_space.shape, args.num_sequences)
@@ -77,14 +159,17 @@ class Trainer:
         # Algorithm to learn.
         self.algo = algo
 
+        # Only the first data-parallel learner evaluates, logs and saves checkpoints.
+        self.is_main = algo.rank == 0
+
         # Log setting.
-        self.log = {"step": [], "return": []}
+        self.log = {"step": [], "return": [], "episodes": [], "ci_half_width": []}
         self.csv_path = os.path.join(log_dir, "log.csv")
         self.log_dir = log_dir
         self.summary_dir = os.path.join(log_dir, "summary")
-        self.writer = SummaryWriter(log_dir=self.summary_dir)
+        self.writer = SummaryWriter(log_dir=self.summary_dir) if self.is_main else NullWriter()
         self.model_dir = os.path.join(log_dir, "model")
-        if not os.path.exists(self.model_dir):
+        if self.is_main and not os.path.exists(self.model_dir):
             os.makedirs(self.model_dir)
 
         # Other parameters.
@@ -92,9 +177,43 @@ class Trainer:
         self.num_steps = int(args.num_steps)
         self.initial_collection_steps = int(args.initial_collection_steps)
         self.initial_learning_steps = int(args.initial_learning_steps)
+        # Replace the initial latent updates by large-batch pretraining in epochs.
+        self.pretrain_latent = int(args.pretrain_batch_size_latent) > 0
         self.eval_interval = int(args.eval_interval)
         self.num_eval_episodes = int(args.eval_num_episodes)
+        # Adaptive evaluation runs episodes until the confidence interval of the mean return is narrow enough,
+        # the checkpoint is clearly worse than the best one, or the episode or time budget is spent.
+        self.eval_adaptive = args.eval_adaptive
+        self.eval_min_episodes = max(2, int(args.eval_min_episodes))
+        self.eval_max_episodes = int(args.eval_max_episodes)
+        self.eval_ci_width = args.eval_ci_width
+        self.eval_confidence = args.eval_confidence
+        self.eval_time_budget = args.eval_time_budget
+        self.best_return = None
+        # Returns imagined by the latent model from replay sequences, logged between evaluations.
+        self.imagination_interval = int(args.imagination_interval)
+        self.imagination_batch_size = int(args.imagination_batch_size)
+        self.imagination_horizon = int(args.imagination_horizon)
+        self.imagination_chunk_size = int(args.imagination_chunk_size)
+        # Memory report of the buffer, networks and updates, logged regularly.
+        self.memory_log_interval = int(args.memory_log_interval)
+        self.memory_swap_fraction = args.memory_swap_fraction
+        # Number of latent and SAC updates per environment step.
+        self.latent_schedule = UpdateSchedule(args.latent_updates_per_step)
+        self.sac_schedule = UpdateSchedule(args.sac_updates_per_step)
         self.current_step = current_steps
+        # Cache of the random-policy transitions, which are then loaded instead of collected.
+        self.random_cache = random_cache
+        # Offline datasets to warm-start the replay buffer from, and to export it to after training.
+        self.dataset_import_dir = args.dataset_import_dir
+        self.dataset_export_dir = args.dataset_export_dir
+        # Offline dataset to pretrain the latent model on before collecting any data.
+        self.dataset_pretrain_dir = args.dataset_pretrain_dir
+        self.dataset_pretrain_epochs = int(args.dataset_pretrain_epochs)
+        # Frozen policy for CPU inference, exported after training.
+        self.policy_export_path = args.policy_export_path
+        self.policy_quantization = args.policy_quantization
+        self.policy_calibration_batches = args.policy_calibration_batches
 
     def train(self):
         # Time to start training.
@@ -102,53 +221,100 @@ class Trainer:
         # Episode's timestep.
         t = 0
         env_id = 0
+        if self.dataset_import_dir:
+            load_dataset(self.algo.buffer, self.dataset_import_dir)
+        # After the import, which leaves the buffer on the dataset's last shard.
+        self.set_shard(env_id)
+        if self.random_cache is not None:
+            self.random_cache.load_into(self.algo.buffer)
+
+        if self.dataset_pretrain_dir:
+            for epoch in range(1, self.dataset_pretrain_epochs + 1):
+                batches = iterate_latent_batches(
+                    self.dataset_pretrain_dir, self.algo.batch_size_latent, self.algo.device
+                )
+                num_updates = self.algo.update_latent_offline(batches, self.writer)
+                self.writer.add_scalar("pretrain/offline_updates", num_updates, epoch)
+
         # Initialize the environment.
         state, _ = self.envs[env_id].reset()
         self.ob.reset_episode(state)
         self.algo.buffer.reset_episode(state)
 
         # Collect trajectories using random policy.
-        bar = tqdm(range(1, self.initial_collection_steps + 1))
-        for step in bar:
-            bar.set_description("Collecting trajectories using random policy.")
-            t = self.algo.step(self.envs[env_id], self.ob, t, step <= self.initial_collection_steps)
+        if self.random_cache is None:
+            bar = tqdm(range(1, self.initial_collection_steps + 1), disable=not self.is_main)
+            for step in bar:
+                bar.set_description("Collecting trajectories using random policy.")
+                t = self.algo.step(self.envs[env_id], self.ob, t, step <= self.initial_collection_steps)
 
         # Update latent variable model first so that SLAC can learn well using (learned) latent dynamics.
         
-        bar = tqdm(range(self.current_step, self.initial_learning_steps))
-        for _ in bar:
-            bar.set_description("Updating latent variable model.")
-            self.algo.update_latent(self.writer)
+        if self.pretrain_latent:
+            epochs = self.algo.pretrain_latent(self.writer)
+            self.writer.add_scalar("pretrain/epochs", epochs, 0)
+        else:
+            bar = tqdm(range(self.current_step, self.initial_learning_steps), disable=not self.is_main)
+            for _ in bar:
+                bar.set_description("Updating latent variable model.")
+                self.algo.update_latent(self.writer)
 
         # Iterate collection, update and evaluation.
         start_env_steps = self.initial_collection_steps + 1 if self.current_step == 1 else self.current_step
-        bar = tqdm(range(start_env_steps, start_env_steps + self.num_steps // self.action_repeat + 1))
+        bar = tqdm(range(start_env_steps, start_env_steps + self.num_steps // self.action_repeat + 1), disable=not self.is_main)
         for step in bar:
 
             
             if t == 0:
-                env_id = np.random.choice(list(range(len(self.envs)))) - 1
+                env_id = np.random.randint(len(self.envs))
+                self.set_shard(env_id)
                 
             t = self.algo.step(self.envs[env_id], self.ob, t, False)
             
             # if t is 0 the episode is over and we sample a next environment to simulate in.
 
             # Update the algorithm.
-            self.algo.update_latent(self.writer)
-            self.algo.update_sac(self.writer)
+            num_updates = self.latent_schedule()
+            if num_updates > 0:
+                self.algo.update_latent(self.writer, num_updates)
+            num_updates = self.sac_schedule()
+            if num_updates > 0:
+                self.algo.update_sac(self.writer, num_updates)
 
             # Evaluate regularly.
             step_env = step * self.action_repeat
-            if step_env % self.eval_interval == 0:
+            if self.is_main and step_env % self.eval_interval == 0:
                 mean_return = self.evaluate(step_env)
                 bar.set_description(f"iter={step} mean_return={mean_return}")
                 self.algo.save_model(os.path.join(self.model_dir, f"step{step_env}"))
                 self.current_step = step
+            if self.is_main and self.imagination_interval > 0 and step_env % self.imagination_interval == 0:
+                self.log_imagination(step_env)
+            if self.is_main and self.memory_log_interval > 0 and step_env % self.memory_log_interval == 0:
+                self.log_memory(step_env)
+
+        if isinstance(self.env_test, VideoRecorder):
+            self.env_test.flush()
+        if self.is_main and self.dataset_export_dir:
+            export_buffer(self.algo.buffer, self.dataset_export_dir)
+        if self.is_main and self.policy_export_path:
+            report = self.algo.export_policy(
+                self.policy_export_path, self.policy_quantization, self.policy_calibration_batches
+            )
+            # The report is also stored in the exported archive.
+            for key in ("action_mse", "latency_ms", "speedup"):
+                self.writer.add_scalar(f"export/{key}", report[key], self.num_steps)
+
+    def set_shard(self, env_id):
+        # Keep the data of each environment variant in its own shard.
+        if self.algo.sharded:
+            self.algo.buffer.set_shard(env_id)
 
     def evaluate(self, step_env):
-        mean_return = 0.0
+        interval = ReturnInterval(self.eval_confidence)
+        start_time = time()
 
-        for i in range(self.num_eval_episodes):
+        while not self.eval_done(interval, time() - start_time):
             state, _ = self.env_test.reset()
             self.ob_test.reset_episode(state)
             episode_return = 0.0
@@ -161,17 +327,60 @@ class Trainer:
                 self.ob_test.append(state, action)
                 episode_return += reward
 
-            mean_return += episode_return / self.num_eval_episodes
+            interval.add(episode_return)
+
+        mean_return = interval.mean
+        if self.best_return is None or mean_return > self.best_return:
+            self.best_return = mean_return
 
         # Log to CSV.
         self.log["step"].append(step_env)
         self.log["return"].append(mean_return)
+        self.log["episodes"].append(interval.count)
+        self.log["ci_half_width"].append(interval.half_width)
         pd.DataFrame(self.log).to_csv(self.csv_path, mode='w', index=False)
 
         # Log to TensorBoard.
         self.writer.add_scalar("return/test", mean_return, step_env)
+        if interval.count > 1:
+            self.writer.add_scalar("return/test_ci_half_width", interval.half_width, step_env)
+        self.writer.add_scalar("return/test_episodes", interval.count, step_env)
+        latency = self.algo.acting.latency_stats()
+        self.writer.add_scalar("acting/latency_p50_ms", latency["p50"], step_env)
+        self.writer.add_scalar("acting/latency_p99_ms", latency["p99"], step_env)
         return mean_return
 
+    def log_imagination(self, step_env):
+        # Prioritized sampling also returns importance sampling weights and indices.
+        state_, action_ = self.algo.buffer.sample_latent(self.imagination_batch_size)[:2]
+        imagination = LatentImagination(self.algo.latent, self.algo.actor, self.imagination_chunk_size)
+        mean, std = imagination.score(state_, action_, self.imagination_horizon, self.algo.gamma)
+        self.writer.add_scalar("return/imagined", mean, step_env)
+        self.writer.add_scalar("return/imagined_std", std, step_env)
+
+    def log_memory(self, step_env):
+        report = algo_memory(self.algo)
+        for key, value in report.items():
+            self.writer.add_scalar(f"memory/{key}_mb", value / MB, step_env)
+        # Warn if the frames still to be stored until the buffer is full would not fit.
+        buffer = self.algo.buffer
+        if "buffer/frames" in report and buffer._n > 0:
+            stored = report["buffer/frames"] + report["buffer/lazy_frames_overhead"]
+            warn_if_swapping(stored * (buffer.buffer_size - buffer._n) / buffer._n, self.memory_swap_fraction)
+
+    def eval_done(self, interval, elapsed):
+        if not self.eval_adaptive:
+            return interval.count >= self.num_eval_episodes
+        if interval.count < self.eval_min_episodes:
+            return False
+        if interval.count >= self.eval_max_episodes or (self.eval_time_budget and elapsed >= self.eval_time_budget):
+            return True
+        if 2 * interval.half_width <= self.eval_ci_width:
+            return True
+        # More episodes would not make this checkpoint the best one.
+        return self.best_return is not None and interval.mean + interval.half_width < self.best_return
+
     @property
     def time(self):
         return str(timedelta(seconds=int(time() - self.start_time)))
+
@@ -1,6 +1,9 @@
 import math
+import queue
+import threading
 
 import torch
+import torch.utils.checkpoint
 from torch import nn
 
 import os
@@ -65,7 +68,132 @@ def reparameterize(mean, log_std):
     return action, calculate_log_pi(log_std, noise, action)
 
 
+def time_limit_mask(env, t, terminated, truncated):
+    """
+    Done flag to store for the t-th transition of an episode. Time limits are not true terminal states. With
+    action repeat, the time limit of a gym env counts physics steps, so truncation is checked as well.
+    """
+    if t == env.spec.max_episode_steps or (truncated and not terminated):
+        return False
+    return terminated or truncated
+
+
+def weighted_mean(x, weights=None):
+    """
+    Mean over the batch, weighted by importance sampling weights if given.
+    """
+    if weights is None:
+        return x.mean()
+    return (x * weights).mean()
+
+
 def calculate_kl_divergence(p_mean, p_std, q_mean, q_std):
     var_ratio = (p_std / q_std).pow_(2)
     t1 = ((p_mean - q_mean) / q_std).pow_(2)
     return 0.5 * (var_ratio + t1 - 1 - var_ratio.log())
+
+
+def run_checkpointed(fn, *args):
+    """
+    Activation checkpoint of fn. The reentrant variant is used because the TorchScript profiling executor may
+    recompute with a differently optimized graph, which the non-reentrant variant rejects. It only tracks
+    gradients when an input requires them, so a dummy input is passed for parameter-only dependencies.
+    """
+    dummy = torch.empty(0, requires_grad=True)
+    return torch.utils.checkpoint.checkpoint(lambda _, *inputs: fn(*inputs), dummy, *args, use_reentrant=True)
+
+
+def run_chunked(fn, tensors, chunk_size, checkpoint=False):
+    """
+    Apply fn to consecutive chunks of chunk_size rows of the given tensors and return the list of outputs.
+    With checkpoint=True the activations of each chunk are recomputed in the backward pass instead of stored.
+    """
+    n = tensors[0].size(0)
+    if chunk_size <= 0:
+        chunk_size = n
+    outputs = []
+    for start in range(0, n, chunk_size):
+        chunk = [x[start : start + chunk_size] for x in tensors]
+        if checkpoint and torch.is_grad_enabled():
+            outputs.append(run_checkpointed(fn, *chunk))
+        else:
+            outputs.append(fn(*chunk))
+    return outputs
+
+
+class ActivationMemoryMeter:
+    """
+    Measure the memory held by tensors saved for the backward pass by the forward pass run inside the context,
+    i.e. the activation memory of an update. On CUDA devices the peak allocated memory is recorded as well.
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.saved_bytes = 0
+        self.peak_allocated_bytes = 0
+        self._storages = set()
+
+    def _pack(self, tensor):
+        storage = tensor.untyped_storage()
+        key = (storage.data_ptr(), storage.device)
+        if key not in self._storages:
+            self._storages.add(key)
+            self.saved_bytes += storage.nbytes()
+        return tensor
+
+    def __enter__(self):
+        self.saved_bytes = 0
+        self._storages.clear()
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self._hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, lambda tensor: tensor)
+        self._hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._hooks.__exit__(*exc)
+        if self.device.type == "cuda":
+            self.peak_allocated_bytes = torch.cuda.max_memory_allocated(self.device)
+        self._storages.clear()
+        return False
+
+
+def prefetch_iterator(iterable, size):
+    """
+    Iterate over iterable in a background thread which runs up to size items ahead of the consumer.
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item, error=None):
+        # Give up once the consumer is gone.
+        while not stop.is_set():
+            try:
+                items.put((item, error), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(end)
+        except Exception as e:
+            put(end, e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,160 @@
+import argparse
+import csv
+import glob
+import hashlib
+import importlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+from multiprocessing.connection import wait
+
+from tqdm import tqdm
+
+from slac_pytorch.common.utils import load_config, parse_args
+
+DONE_FILE = "done.json"
+RESULTS_FILE = "results.csv"
+
+def expand_spec(spec):
+    """
+    Expand a sweep spec into a list of config overrides. "grid" maps keys to lists of values which are fully
+    crossed. "random" maps keys to a list of choices or to {"low", "high", "log"} ranges, and num_samples
+    random draws (seeded by "seed") are crossed with the grid.
+    """
+    grid = spec.get("grid", {})
+    keys = list(grid)
+    points = [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+    space = spec.get("random", {})
+    if not space:
+        return points
+    rng = random.Random(spec.get("seed", 0))
+    samples = []
+    for _ in range(int(spec.get("num_samples", 1))):
+        sample = {}
+        for key, dist in space.items():
+            if isinstance(dist, list):
+                sample[key] = rng.choice(dist)
+            elif dist.get("log", False):
+                sample[key] = math.exp(rng.uniform(math.log(dist["low"]), math.log(dist["high"])))
+            else:
+                sample[key] = rng.uniform(dist["low"], dist["high"])
+        samples.append(sample)
+    return [{**point, **sample} for point in points for sample in samples]
+
+
+def run_name(overrides):
+    """
+    Directory name of a run, readable and unique for its overrides.
+    """
+    scalars = sorted((key, value) for key, value in overrides.items() if not isinstance(value, (list, dict)))
+    readable = ",".join(f"{key}={value}" for key, value in scalars)
+    digest = hashlib.sha256(json.dumps(overrides, sort_keys=True).encode()).hexdigest()[:8]
+    return f"{readable.replace('/', '_')[:100]}-{digest}" if readable else digest
+
+
+def _run(script, config_file, overrides, run_dir, cores):
+    # Pin the run to its slot of cores and size the torch thread pool accordingly.
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    import torch
+
+    torch.set_num_threads(len(cores))
+    args = parse_args(args_file=config_file)
+    for key, value in overrides.items():
+        assert hasattr(args, key), f"Unknown config key: {key}"
+        setattr(args, key, value)
+    args.working_dir = run_dir + os.sep
+    importlib.import_module(script).main(args)
+    with open(os.path.join(run_dir, DONE_FILE), "w") as f:
+        json.dump(overrides, f)
+
+
+def read_returns(run_dir):
+    """
+    Evaluation returns logged by the run, as a list of (step, return).
+    """
+    paths = glob.glob(os.path.join(run_dir, "logs", "runs", "**", "log.csv"), recursive=True)
+    paths = sorted(paths, key=os.path.getmtime)
+    if not paths:
+        return []
+    with open(paths[-1]) as f:
+        return [(int(float(row["step"])), float(row["return"])) for row in csv.DictReader(f)]
+
+
+def write_results(out_dir, runs):
+    """
+    Write one row per run with its overrides, status and final and best evaluation returns.
+    """
+    keys = sorted({key for overrides, _ in runs for key in overrides})
+    with open(os.path.join(out_dir, RESULTS_FILE), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["run", *keys, "status", "last_step", "final_return", "best_return"])
+        for overrides, run_dir in runs:
+            returns = read_returns(run_dir)
+            status = "done" if os.path.exists(os.path.join(run_dir, DONE_FILE)) else "incomplete"
+            last_step, final_return = returns[-1] if returns else ("", "")
+            best_return = max(r for _, r in returns) if returns else ""
+            values = [json.dumps(overrides[key]) if key in overrides else "" for key in keys]
+            writer.writerow([os.path.basename(run_dir), *values, status, last_step, final_return, best_return])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a sweep of SLAC configurations on a local process pool.")
+    parser.add_argument("--spec", required=True, help="JSON sweep spec with grid and/or random keys")
+    parser.add_argument("--out", required=True, help="directory for the runs and the results table")
+    parser.add_argument("--config", default="./data/configs/default.json", help="base configuration")
+    parser.add_argument("--script", default="train", choices=["train", "train_obs"])
+    parser.add_argument("--cores-per-run", type=int, default=1)
+    parser.add_argument("--dry-run", action="store_true", help="only list the runs")
+    cli = parser.parse_args()
+
+    spec = load_config(cli.spec)
+    runs = [(overrides, os.path.join(cli.out, run_name(overrides))) for overrides in expand_spec(spec)]
+    # Finished runs are skipped. Unfinished ones cannot be resumed, so they are cleared and restarted from scratch.
+    pending = [run for run in runs if not os.path.exists(os.path.join(run[1], DONE_FILE))]
+    stale = [run_dir for _, run_dir in pending if os.path.exists(run_dir)]
+    tqdm.write(f"{len(runs)} runs, {len(runs) - len(pending)} already done, {len(stale)} to restart from scratch.")
+    if cli.dry_run:
+        for overrides, run_dir in pending:
+            tqdm.write(f"{run_dir} {overrides}")
+        return
+    for run_dir in stale:
+        shutil.rmtree(run_dir)
+
+    # Pack as many runs as there are disjoint slots of cores.
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    cores_per_run = max(1, min(cli.cores_per_run, len(cores)))
+    num_slots = max(1, len(cores) // cores_per_run)
+    free_cores = [set(cores[i * cores_per_run : (i + 1) * cores_per_run]) for i in range(num_slots)]
+
+    os.makedirs(cli.out, exist_ok=True)
+    # Each run gets a fresh process, so that no state leaks between runs.
+    context = multiprocessing.get_context("spawn")
+    queued, running = list(pending), {}
+    bar = tqdm(total=len(pending), desc="Runs")
+    while queued or running:
+        while queued and free_cores:
+            overrides, run_dir = queued.pop(0)
+            os.makedirs(run_dir, exist_ok=True)
+            slot = free_cores.pop()
+            process = context.Process(target=_run, args=(cli.script, cli.config, overrides, run_dir, slot))
+            process.start()
+            running[process.sentinel] = (process, run_dir, slot)
+        for sentinel in wait(list(running)):
+            process, run_dir, slot = running.pop(sentinel)
+            process.join()
+            free_cores.append(slot)
+            bar.update()
+            if process.exitcode != 0:
+                tqdm.write(f"Failed {run_dir}: exit code {process.exitcode}")
+        write_results(cli.out, runs)
+    bar.close()
+    write_results(cli.out, runs)
+
+if __name__ == "__main__":
+    main()
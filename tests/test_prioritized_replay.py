@@ -0,0 +1,28 @@
+import numpy as np
+import torch
+
+from slac_pytorch.buffer import PrioritizedReplayBuffer
+from slac_pytorch.network import LatentModel
+
+NUM_SEQUENCES = 2
+STATE_SHAPE = (3, 64, 64)
+
+
+def test_worse_reconstruction_gets_higher_priority():
+    torch.manual_seed(0)
+    latent = LatentModel(STATE_SHAPE, (1,))
+    with torch.no_grad():
+        z_ = torch.randn(1, NUM_SEQUENCES + 1, 32 + 256).repeat(2, 1, 1)
+        state_mean_, _ = latent.decoder(z_)
+        # Both sequences are reconstructed well enough for a negative log-likelihood.
+        noise_ = torch.randn_like(state_mean_)
+        state_ = state_mean_ + noise_ * torch.tensor([0.05, 0.2]).view(2, 1, 1, 1, 1)
+        loss_image_ = latent.calculate_image_loss(z_, state_)
+        errors = latent.reconstruction_error(loss_image_, state_)
+    assert (loss_image_ < 0).all()
+    assert (errors >= 0).all()
+
+    buffer = PrioritizedReplayBuffer(4, NUM_SEQUENCES, STATE_SHAPE, (1,), torch.device("cpu"))
+    buffer.update_latent_priorities(np.arange(2), errors.numpy())
+    better, worse = buffer.tree_latent.get(np.arange(2))
+    assert worse > better
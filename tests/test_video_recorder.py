@@ -0,0 +1,103 @@
+import glob
+
+import gymnasium as gym
+import numpy as np
+from gymnasium import spaces
+
+from slac_pytorch.environments.pool import PrewarmedEnv
+from slac_pytorch.environments.remote import RemoteEnv
+from slac_pytorch.environments.wrappers import VideoRecorder
+
+EPISODE_STEPS = 5
+
+
+class ImageEnv(gym.Env):
+    """
+    Episodes of EPISODE_STEPS steps whose (3, 8, 8) observations are filled with the step number.
+    """
+
+    observation_space = spaces.Box(low=0, high=255, shape=(3, 8, 8), dtype=np.uint8)
+    action_space = spaces.Box(low=-1.0, high=1.0, shape=(2,), dtype=np.float32)
+
+    def __init__(self):
+        self.t = 0
+        self.action_repeat = 1
+
+    def _observation(self):
+        return np.full(self.observation_space.shape, self.t, dtype=np.uint8)
+
+    def reset(self, seed=None, options=None):
+        super().reset(seed=seed)
+        self.t = 0
+        return self._observation(), {}
+
+    def step(self, action):
+        self.t += 1
+        return self._observation(), 0.0, False, self.t == EPISODE_STEPS, {}
+
+    def render(self):
+        return self._observation().transpose(1, 2, 0)
+
+
+class LocalClient:
+    """
+    Stands in for an EnvClient by running the environments in process.
+    """
+
+    def __init__(self, num_envs):
+        self.envs = [ImageEnv() for _ in range(num_envs)]
+        self.closed = False
+
+    def reset(self, idxes, seeds):
+        return np.stack([self.envs[i].reset(seed=seed)[0] for i, seed in zip(idxes, seeds)])
+
+    def step(self, idxes, actions):
+        results = [self.envs[i].step(action) for i, action in zip(idxes, actions)]
+        states, rewards, terminated, truncated = (np.array([r[k] for r in results]) for k in range(4))
+        return states, rewards, terminated, truncated
+
+    def release(self, idxes):
+        for i in idxes:
+            self.envs[i] = None
+
+
+def run_episodes(env, num_episodes):
+    for _ in range(num_episodes):
+        env.reset()
+        done = False
+        while not done:
+            _, _, terminated, truncated, _ = env.step(env.action_space.sample())
+            done = terminated or truncated
+
+
+def recorded_frames(video_dir):
+    return [np.load(path)["frames"] for path in sorted(glob.glob(f"{video_dir}/*.npz"))]
+
+
+def check_recorder(env, video_dir, source):
+    recorder = VideoRecorder(env, str(video_dir), every_n_episodes=2, source=source, video_format="npz")
+    assert recorder.observation_space.shape == (3, 8, 8)
+    assert recorder.spec is env.spec
+    run_episodes(recorder, 3)
+    recorder.flush()
+    recorder.close()
+
+    videos = recorded_frames(video_dir)
+    assert len(videos) == 2
+    for frames in videos:
+        assert frames.shape == (EPISODE_STEPS + 1, 8, 8, 3)
+        np.testing.assert_array_equal(frames[:, 0, 0, 0], np.arange(EPISODE_STEPS + 1))
+
+
+def test_prewarmed_env(tmp_path):
+    env = PrewarmedEnv(ImageEnv)
+    env.reset(seed=0)
+    check_recorder(env, tmp_path / "render", "render")
+
+
+def test_remote_env(tmp_path):
+    env = ImageEnv()
+    client = LocalClient(1)
+    remote = RemoteEnv(client, 0, env.action_space, env.observation_space, dict(max_episode_steps=5, action_repeat=1))
+    check_recorder(remote, tmp_path / "observation", "observation")
+    assert client.envs == [None]
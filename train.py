@@ -3,93 +3,35 @@ import os
 from datetime import datetime
 
 import torch
+from tqdm import tqdm
 
-from slac_pytorch.common.xml_manager import XML
 from slac_pytorch.algo import SlacAlgorithm, ObsSlacAlgorithm
-from slac_pytorch.env import make_dmc, make_gym
+from slac_pytorch.collection import RandomCollectionCache
 from slac_pytorch.trainer import Trainer
 from slac_pytorch.common.utils import parse_args, save_config
-from slac_pytorch.environments.wrappers import AntImageWrapper
+from slac_pytorch.distributed import close_learner, get_rank, init_learner
+from slac_pytorch.memory import check_config, format_report
+from slac_pytorch.environments.factory import EnvVariantFactory
+from slac_pytorch.environments.remote import EnvClient
 
 
 def main(args):
-    masses = [2.5, 2.5, 7.5, 7.5]
-    frictions = [0.5, 1.5, 0.5, 1.5]
+    # Environment variants, unless configured.
+    masses = args.variant_masses or [2.5, 2.5, 7.5, 7.5]
+    frictions = args.variant_frictions or [0.5, 1.5, 0.5, 1.5]
     
-    pairs = list(zip(masses, frictions))
-    envs = []
-    xml = XML()
-    
-    for pair in pairs[:-1]:
-        mass, friction = pair
-        
-        values = dict(mass=mass, 
-                      friction=friction)
-        
-        xml.modify(input_file=args.agent_path, output_file=args.agent_path ,values=values)
-
-        if args.universe == 'gym':
-            
-            env = make_gym(
-                env=args.domain_name,
-                action_repeat=args.action_repeat,
-                render_mode=args.render_mode,
-                environment_kwargs=dict(
-                    xml_file=args.agent_path
-                )
-            )
-            
-            # Wrap the environment with our custom wrapper
-            env = AntImageWrapper(env, image_size=(64, 64))
-                        
-        else:
-
-            env = make_dmc(
-                domain_name=args.domain_name,
-                task_name=args.task_name,
-                action_repeat=args.action_repeat,
-                from_pixels=True,
-                image_size=64,
-                environment_kwargs=dict(
-                    agent_path=args.agent_path
-                )
-            )
-        envs.append(env)
-            
-    for pair in pairs[-1:]:
-
-        mass, friction = pair
-                
-        values = dict(mass=mass, 
-                    friction=friction)
-        
-        xml.modify(input_file=args.agent_path, output_file=args.agent_path ,values=values)
-        
-        
-        if args.universe == 'gym':
-            env_test = make_gym(
-                env=args.domain_name,
-                action_repeat=args.action_repeat,
-                render_mode=args.render_mode,
-                environment_kwargs=dict(
-                    xml_file=args.agent_path
-                )
-            )
-            # Wrap the environment with our custom wrapper
-            env_test = AntImageWrapper(env_test, image_size=(64, 64))
-            
-        else:
-        
-            env_test = make_dmc(
-                domain_name=args.domain_name,
-                task_name=args.task_name,
-                action_repeat=args.action_repeat,
-                from_pixels=True,
-                image_size=64,
-                environment_kwargs=dict(
-                    agent_path=args.agent_path
-                )
-            )
+    variants = [dict(mass=mass, friction=friction) for mass, friction in zip(masses, frictions)]
+    factory = EnvVariantFactory(args, cache_dir=args.env_cache_dir, num_workers=args.env_workers)
+
+    # The last variant is held out for evaluation.
+    env_client = None
+    if args.env_server:
+        # Step the environments on a remote environment server instead of in this process.
+        env_client = EnvClient(args.env_server)
+        *envs, env_test = env_client.make(variants, from_pixels=True, universe=None)
+    else:
+        *envs, env_test = factory.make_all(variants, from_pixels=True, prewarm=args.env_prewarm)
+    env = envs[-1]
 
     parameters_dir = os.path.join(
         f"{args.working_dir}logs/parameters/",
@@ -97,7 +39,8 @@ def main(args):
         f'slac-{args.domain_name}-{args.task_name}-{datetime.now().strftime("%Y%m%d-%H%M")}'
     )
     
-    save_config(args, parameters_dir)
+    if get_rank() == 0:
+        save_config(args, parameters_dir)
 
     log_dir = os.path.join(
         f"{args.working_dir}logs/runs/",
@@ -106,25 +49,58 @@ def main(args):
     )
 
 
+    device = torch.device("cuda" if args.cuda else "cpu")
+    # Predict the memory use before the replay buffer fills up.
+    if args.memory_check and get_rank() == 0:
+        report = check_config(args, env, device, obs=False, num_envs=len(envs))
+        tqdm.write(f"Predicted memory use:\n{format_report(report)}")
+
     algo = SlacAlgorithm(
         state_shape=env.observation_space.shape,
         action_shape=env.action_space.shape,
         action_repeat=args.action_repeat,
-        device=torch.device("cuda" if args.cuda else "cpu"),
-        args=args
+        device=device,
+        args=args,
+        num_envs=len(envs),
     )
 
+    # The random-policy phase runs in the first variant.
+    random_cache = RandomCollectionCache(args, variants[0], True, None) if args.random_cache_dir else None
+
     trainer = Trainer(
         envs=envs,
         env=env,
         env_test=env_test,
         algo=algo,
         log_dir=log_dir,
+        random_cache=random_cache,
         args=args,
     )
-    trainer.train()
+    try:
+        trainer.train()
+    finally:
+        # Release the instances on the environment server.
+        if env_client is not None:
+            env_client.close()
+
+
+def run_learner(rank, args):
+    """
+    Entry point of one data-parallel learner process.
+    """
+    init_learner(rank, args.num_learners, init_method=args.dist_init_method)
+    # Split the cores between the learners and let each one collect its own shard of experience.
+    torch.set_num_threads(max(1, os.cpu_count() // args.num_learners))
+    args.seed = args.seed + rank
+    try:
+        main(args)
+    finally:
+        close_learner()
 
 
 if __name__ == "__main__":
     args = parse_args(args_file="./data/configs/default.json")
-    main(args)
+    if args.num_learners > 1:
+        torch.multiprocessing.spawn(run_learner, args=(args,), nprocs=args.num_learners)
+    else:
+        main(args)